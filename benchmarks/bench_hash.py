@@ -0,0 +1,97 @@
+"""Compare util.hash_stream (readinto on one reused, adaptively sized buffer)
+with the 64KiB f.read loop hashfile used before it, on the same file. By
+default the file is read once first so everything comes out of the page
+cache; with --cold its pages are dropped (POSIX_FADV_DONTNEED) before each
+run instead. The best of a few runs is reported for each, and --bs tries
+hash_stream with other buffer sizes (in KiB) alongside the adaptive one.
+
+    python benchmarks/bench_hash.py [--size-mb 512] [--runs 3] [--alg sha256] [--cold] [--bs 64,1024] [--path FILE]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from chitin.client import util
+
+def drop_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def old_loop(path, halg, bs=65536):
+    # As hashfile did it before hash_stream
+    with open(path, "rb") as f:
+        h = halg()
+        buff = f.read(bs)
+        h.update(buff)
+        while len(buff) > 0:
+            buff = f.read(bs)
+            h.update(buff)
+    return h.hexdigest()
+
+def new_stream(path, halg, bs):
+    with open(path, "rb", buffering=0) as f:
+        h = halg()
+        util.hash_stream(f, h, bs)
+    return h.hexdigest()
+
+def best_of(runs, cold, fn, path, *args):
+    best = None
+    digest = None
+    for run in range(runs):
+        if cold:
+            drop_cache(path)
+        start_time = time.perf_counter()
+        digest = fn(path, *args)
+        t = time.perf_counter() - start_time
+        best = t if best is None else min(best, t)
+    return best, digest
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--alg", default=None, help="one of util.HASH_ALGORITHMS (default HASH_ALG)")
+    parser.add_argument("--cold", action="store_true", help="drop the file from the page cache before each run")
+    parser.add_argument("--bs", default="", help="comma separated buffer sizes (KiB) to try hash_stream with as well")
+    parser.add_argument("--path", help="hash this file rather than a temporary one")
+    args = parser.parse_args()
+
+    alg_name, halg = util.get_hash_algorithm(args.alg)
+    path = args.path
+    if not path:
+        # Not in /tmp, which may well be a tmpfs with no disk behind it
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(__file__)))
+        with os.fdopen(fd, "wb") as fh:
+            for i in range(args.size_mb):
+                fh.write(os.urandom(1048576))
+    try:
+        size = os.path.getsize(path)
+        size_mb = size / 1048576.0
+        if not args.cold:
+            old_loop(path, halg) # warm the page cache
+
+        print("%s over %.0fMB, %s page cache, best of %d" % (alg_name, size_mb, "cold" if args.cold else "warm", args.runs))
+        old_t, old_digest = best_of(args.runs, args.cold, old_loop, path, halg)
+        print("%-24s %7.3fs %8.1fMB/s" % ("f.read 64KiB", old_t, size_mb / old_t))
+
+        sizes = [("hash_stream (adaptive)", util.adaptive_block_size(size))]
+        sizes.extend([("hash_stream", int(kib) * 1024) for kib in args.bs.split(",") if kib])
+        for label, bs in sizes:
+            new_t, new_digest = best_of(args.runs, args.cold, new_stream, path, halg, bs)
+            if new_digest != old_digest:
+                sys.exit("Digests differ!")
+            print("%-24s %7.3fs %8.1fMB/s (%dKiB buffer)" % (label, new_t, size_mb / new_t, bs // 1024))
+    finally:
+        if not args.path:
+            os.unlink(path)
+
+if __name__ == "__main__":
+    main()
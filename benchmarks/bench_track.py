@@ -0,0 +1,88 @@
+"""How much each tracking backend costs around a command: runs a command that
+writes a few hundred files in a dir (under the first of conf.ROOTS) that
+already has a few thousand in it, under each backend that works here, and reports the median time the command
+itself took (strace slows the command down) and chitin's overhead around it.
+
+    python benchmarks/bench_track.py [--runs 5] [--existing 5000] [--writes 200]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from chitin.client import ClientDaemon, conf, inotify, trace
+from chitin.client.api import base
+
+COMMAND = "i=0; while [ $i -lt %d ]; do echo $i > out/f$i.txt; i=$((i+1)); done"
+
+def clear_writes(n):
+    for i in range(n):
+        try:
+            os.unlink(os.path.join("out", "f%d.txt" % i))
+        except OSError:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--existing", type=int, default=5000, help="files already in the dir the command writes to")
+    parser.add_argument("--writes", type=int, default=200, help="files the command writes")
+    args = parser.parse_args()
+
+    # Nothing here is worth sending anywhere
+    base.queue_emit = lambda endpoint, payload, to_uuid=None: None
+
+    # Resources have to live under one of conf.ROOTS
+    roots = sorted(getattr(conf, "ROOTS", {}))
+    if not roots:
+        sys.exit("Needs a conf.ROOTS entry to work under")
+    work_dir = tempfile.mkdtemp(dir=roots[0])
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        os.mkdir("out")
+        for i in range(args.existing):
+            with open(os.path.join("out", "old%d.txt" % i), "w") as fh:
+                fh.write(str(i))
+        cmd_str = COMMAND % args.writes
+
+        bare = []
+        for run in range(args.runs):
+            start_time = time.perf_counter()
+            subprocess.run(cmd_str, shell=True, check=True)
+            bare.append(time.perf_counter() - start_time)
+            clear_writes(args.writes)
+        print("%-10s command %7.1fms" % ("bare", statistics.median(bare) * 1000))
+
+        backends = ["snapshot"]
+        for name, available in [("inotify", inotify.available), ("strace", trace.available)]:
+            if available():
+                backends.append(name)
+            else:
+                print("%-10s not available here, skipped" % name)
+
+        for backend in backends:
+            command_ms = []
+            overhead_ms = []
+            for run in range(args.runs + 1):
+                clear_writes(args.writes)
+                report = ClientDaemon.run_command(str(uuid.uuid4()), cmd_str, track=backend)["overhead"]
+                if run == 0:
+                    # Warms the hash cache for the files that were already there
+                    continue
+                command_ms.append(report["phases"]["command"]["ms"])
+                overhead_ms.append(report["overhead_ms"])
+            print("%-10s command %7.1fms  overhead %7.1fms" % (backend, statistics.median(command_ms), statistics.median(overhead_ms)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Time listing a synthetic dir of many files (100k by default, plus a few
+subdirs) the way inflate_path_set and parse_tokens did before walk.py
+(os.listdir and an isdir/isfile per entry) against walk.list_dir's single
+scandir pass, and a stat snapshot of it for comparison. Best of a few runs.
+
+    python benchmarks/bench_walk.py [--files 100000] [--subdirs 10] [--runs 3]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from chitin.client import inflate_path_set, snapshot, walk
+
+def old_inflate_path_set(path_set):
+    # As inflate_path_set did it before walk.py
+    paths = set({})
+    for item in path_set:
+        item = os.path.abspath(item)
+        if os.path.isdir(item):
+            for subitem in os.listdir(item):
+                i_abspath = os.path.join(item, subitem)
+                if os.path.isdir(i_abspath):
+                    pass
+                else:
+                    paths.add(i_abspath)
+        elif os.path.isfile(item):
+            paths.add(item)
+    return paths
+
+def old_subdirs(abspath):
+    # As parse_tokens found a named dir's subdirs before walk.py
+    dirs_l = []
+    for item in os.listdir(abspath):
+        i_abspath = os.path.join(abspath, item)
+        if os.path.isdir(i_abspath):
+            dirs_l.append(i_abspath)
+    return dirs_l
+
+def new_subdirs(abspath):
+    subfiles, subdirs = walk.list_dir(abspath)
+    return [entry.path for entry in subdirs]
+
+def best_of(runs, fn, *args):
+    best = None
+    ret = None
+    for run in range(runs):
+        start_time = time.perf_counter()
+        ret = fn(*args)
+        t = time.perf_counter() - start_time
+        best = t if best is None else min(best, t)
+    return best, ret
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--subdirs", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        for i in range(args.files):
+            open(os.path.join(work_dir, "f%d.txt" % i), "w").close()
+        for i in range(args.subdirs):
+            os.mkdir(os.path.join(work_dir, "d%d" % i))
+
+        print("%d files and %d subdirs in one dir, best of %d" % (args.files, args.subdirs, args.runs))
+        for label, old, new in [
+                ("inflate_path_set", old_inflate_path_set, inflate_path_set),
+                ("named dir subdirs", old_subdirs, new_subdirs),
+            ]:
+            arg = [work_dir] if label == "inflate_path_set" else work_dir
+            old_t, old_ret = best_of(args.runs, old, arg)
+            new_t, new_ret = best_of(args.runs, new, arg)
+            if sorted(old_ret) != sorted(new_ret):
+                sys.exit("%s results differ!" % label)
+            print("%-18s listdir+isdir %7.3fs  scandir %7.3fs  (%.1fx)" % (label, old_t, new_t, old_t / new_t))
+
+        snap_t, snap = best_of(args.runs, snapshot.Snapshot, [work_dir])
+        print("%-18s %7.3fs for %d entries" % ("Snapshot", snap_t, len(snap.paths())))
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
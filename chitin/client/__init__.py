@@ -1,27 +1,46 @@
 import signal
+import syslog
 import subprocess
 import uuid
 import os
 import sys
 import glob
+import time
+import stat as stat_module
 
 from datetime import datetime
-#from shutil import which
-from whichcraft import which # fucking python2v3 bullshit in 2018 ffs
 
 #import chitin.client.api as api
 from .api import base
+from . import capture
+from . import ingest
+from . import inotify
 from . import cmd
 from . import conf
+from . import memo
+from . import phases
+from . import scan
+from . import schedule
+from . import script
+from . import snapshot
+from . import trace
+from . import usage
 from . import util
+from . import walk
 
 
 
+@phases.timed("parse_tokens")
 def parse_tokens(fields):
     dirs_l = []
+    named_dirs_l = []
     file_l = []
     maybe_file_l = []
+    maybe_fields = []
+    globs = []
     executables = []
+    parent_exists = {} # most tokens share a parent (the cwd), so only stat each once
+    executable_index = util.get_executable_index()
 
     fields.append( os.path.abspath(".") ) # always spy on the current dir, i guess?
     for field_i, field in enumerate(fields):
@@ -38,6 +57,7 @@ def parse_tokens(fields):
         if '*' in field:
             # Let's try some fucking globbo
             # Don't update the actual field though, because it'll probably be a fucking disaster
+            globs.append(field)
             file_l.extend([os.path.abspath(x) for x in glob.glob(field)])
 
         #if field.startswith("chitin://"):
@@ -47,7 +67,8 @@ def parse_tokens(fields):
         abspath = os.path.abspath(field)
 
         # Does the path exist? We might want to add its parent directory
-        if os.path.exists(abspath):
+        st = walk.stat(abspath)
+        if st:
             field_ = abspath
 
             if had_semicolon:
@@ -56,64 +77,78 @@ def parse_tokens(fields):
                 fields[field_i] = field_ # Update the command to use the full abspath
         else:
             # Is the field an executable in the PATH?
-            which_path = which(field)
+            which_path = executable_index.which(field)
             if which_path:
                 executables.append(which_path)
 
             # Perhaps this is a file that has previously existed or is about to exist?
-            if os.path.exists(os.path.dirname(abspath)):
+            parent = os.path.dirname(abspath)
+            if parent not in parent_exists:
+                parent_exists[parent] = walk.stat(parent) is not None
+            if parent_exists[parent]:
                 maybe_file_l.append(abspath)
+                maybe_fields.append((field_i, abspath, had_semicolon))
             continue
 
         ### Files
-        if os.path.isfile(abspath):
+        if stat_module.S_ISREG(st.st_mode):
             file_l.append(abspath)
 
-            # Is the path an executable script?
-            if os.access(abspath, os.X_OK):
+            # Is the path an executable script? (only ask if it has any x bits)
+            if st.st_mode & 0o111 and os.access(abspath, os.X_OK):
                 executables.append(abspath)
 
         ### Dirs
-        elif os.path.isdir(abspath):
+        elif stat_module.S_ISDIR(st.st_mode):
             dirs_l.append(abspath)
+            named_dirs_l.append(abspath)
 
-            for item in os.listdir(abspath):
-                i_abspath = os.path.join(abspath, item)
-                if os.path.isdir(i_abspath):
-                    dirs_l.append(i_abspath)
-                else:
-                    #TODO Do we want to keep track of the files of subfolders?
-                    pass
+            #TODO Do we want to keep track of the files of subfolders?
+            subfiles, subdirs = walk.list_dir(abspath)
+            dirs_l.extend([entry.path for entry in subdirs])
 
     return {
         "fields": fields[:-1], # remove sneaky abspath(.) field
         "files": set(file_l),
         "dirs": set(dirs_l),
+        "named_dirs": set(named_dirs_l),
         "maybe_files": set(maybe_file_l),
+        "maybe_fields": maybe_fields,
+        "globs": globs,
         "executables": {os.path.basename(p):p for p in set(executables)},
     }
 
+@phases.timed("inflate_path_set")
 def inflate_path_set(path_set):
     paths = set({})
     for item in path_set:
         item = os.path.abspath(item)
 
-        if os.path.isdir(item):
-            for subitem in os.listdir(item):
-                i_abspath = os.path.join(item, subitem)
-                if os.path.isdir(i_abspath):
-                    #TODO Do we want to keep track of the files of untargeted subfolders?
-                    pass
-                else:
-                    paths.add(i_abspath)
-        elif os.path.isfile(item):
+        st = walk.stat(item)
+        if not st:
+            continue
+        if stat_module.S_ISDIR(st.st_mode):
+            #TODO Do we want to keep track of the files of untargeted subfolders?
+            subfiles, subdirs = walk.list_dir(item)
+            paths.update([entry.path for entry in subfiles])
+        elif stat_module.S_ISREG(st.st_mode):
             paths.add(item)
 
     return paths
 
 class ClientDaemon(object):
     @staticmethod
-    def run_command(cmd_uuid, cmd_str):
+    def run_command(cmd_uuid, cmd_str, force_hash=False, foreign_paths=None, track=None):
+        # Time (and if CHITIN_PROFILE is set, profile) everything we do around the command
+        timer = phases.PhaseTimer()
+        with timer.active(), phases.profiled(cmd_uuid):
+            result = ClientDaemon._run_command(cmd_uuid, cmd_str, force_hash=force_hash, foreign_paths=foreign_paths, track=track)
+        result["overhead"] = timer.report(exclude="command")
+        phases.log_report(cmd_uuid, result["overhead"])
+        return result
+
+    @staticmethod
+    def _run_command(cmd_uuid, cmd_str, force_hash=False, foreign_paths=None, track=None):
         def preexec_function():
             # http://stackoverflow.com/questions/5045771/python-how-to-prevent-subprocesses-from-receiving-ctrl-c-control-c-sigint <3
             # Ignore the SIGINT signal by setting the handler to the standard signal handler SIG_IGN
@@ -127,27 +162,75 @@ class ClientDaemon(object):
         # Organise watch lists (to keep track of deleted files later)
         fields = cmd_str.split(" ")
         token_p = parse_tokens(fields)
-        watched_dirs = token_p["dirs"]
-        watched_files = token_p["files"]
 
-        precommand_paths = inflate_path_set( set(watched_files) )
+        # Either listen for changes around the command as it runs, or take note of
+        # everything we're watching before it starts to compare with afterwards
+        track = track or inotify.TRACK_BACKEND
+        watcher = None
+        tracer = None
+        if track == "strace":
+            if trace.available():
+                tracer = trace.TraceParser(os.path.abspath("."))
+            else:
+                syslog.syslog('Falling back to snapshots for %s (%s not found, or not allowed to trace)' % (cmd_uuid, trace.STRACE))
+        elif track == "inotify":
+            with phases.timed("watch"):
+                roots = inotify.watch_roots(token_p)
+                try:
+                    watcher = inotify.InotifyWatcher(roots)
+                except inotify.InotifyError as e:
+                    syslog.syslog('Falling back to snapshots for %s (%s)' % (cmd_uuid, str(e)))
+        if watcher is None and tracer is None:
+            with phases.timed("snapshot"):
+                precommand = snapshot.Snapshot(token_p["dirs"], token_p["files"])
 
         start_clock = datetime.now()
-        proc = subprocess.Popen(
-                cmd_str,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                #env=dict(os.environ).update(block["env_vars"]),
-                preexec_fn = preexec_function,
-        )
-        stdout, stderr = proc.communicate()
+        start_ns = time.time_ns()
+        with phases.timed("command"):
+            start_time = time.monotonic()
+            if tracer:
+                # Run it under strace, reading the trace back as it's written
+                trace_r, trace_w = os.pipe()
+                proc = subprocess.Popen(
+                        trace.command(cmd_str, "/dev/fd/%d" % trace_w),
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        pass_fds=(trace_w,),
+                        preexec_fn = preexec_function,
+                )
+                os.close(trace_w)
+                trace_thread = trace.follow_in_thread(tracer, os.fdopen(trace_r, errors="replace"))
+            else:
+                proc = subprocess.Popen(
+                        cmd_str,
+                        shell=True,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        #env=dict(os.environ).update(block["env_vars"]),
+                        preexec_fn = preexec_function,
+                )
+            monitor = usage.ProcessMonitor(proc.pid)
+            # Stream the output through (rather than buffering it all with communicate)
+            stdout, stderr = capture.capture_process(proc, wait=False)
+            monitor.sample() # one last look before it is reaped
+            rusage = usage.wait(proc)
+            wall = time.monotonic() - start_time
+            io = monitor.stop()
+            if tracer:
+                trace_thread.join()
         end_clock = datetime.now()
         return_code = proc.returncode
 
         run_meta = [
-            { "tag": "meta", "name": "wall", "type": "int", "value": str(end_clock - start_clock)}
+            { "tag": "meta", "name": "wall", "type": "str", "value": str(end_clock - start_clock)}
         ]
+        run_meta.extend(usage.usage_meta(wall, rusage, io))
+        for stream_name, stream in [("stdout", stdout), ("stderr", stderr)]:
+            run_meta.extend([
+                { "tag": "meta", "name": stream_name + "_bytes", "type": "int", "value": str(stream.n_bytes)},
+                { "tag": "meta", "name": stream_name + "_hash", "type": "str", "value": stream.digest()},
+                { "tag": "meta", "name": stream_name + "_hash_alg", "type": "str", "value": stream.halg_name},
+            ])
 
         if return_code != 0:
             #TODO Future: We should do something here - like warn/stop the command?
@@ -155,159 +238,142 @@ class ClientDaemon(object):
 
         #####################################
 
-        # Update field tokens (to find newly created files)
-        fields = cmd_str.split(" ")
-        token_p = parse_tokens(fields)
-        watched_dirs = watched_dirs.union(token_p["dirs"])
-        #watched_dirs.add(command_r["job_path"])
-        watched_files = watched_files.union(token_p["files"])
-
-        cmd_str = " ".join(token_p["fields"]) # Replace cmd_str to use abspaths
-
-        # Parse the output, apply any appropriate executable handlers
+        # Rather than tokenising all over again, just check whether any of the
+        # maybe_files (or globs) now exist, to find newly created files and dirs
+        fields = token_p["fields"]
+        watched_files = set(token_p["files"])
+        new_dirs = set()
+        for field_i, abspath, had_semicolon in token_p["maybe_fields"]:
+            if os.path.exists(abspath):
+                fields[field_i] = abspath + ';' if had_semicolon else abspath
+        for abspath in token_p["maybe_files"]:
+            if os.path.isdir(abspath):
+                new_dirs.add(abspath)
+            elif os.path.isfile(abspath):
+                watched_files.add(abspath)
+        for field in token_p["globs"]:
+            watched_files.update([os.path.abspath(x) for x in glob.glob(field)])
+
+        if tracer:
+            with phases.timed("trace"):
+                # Exactly what the command opened, so there's nothing else to look at.
+                # Only the files that were there before it ran, not the maybe_files it made
+                changes = tracer.changes(named_files=token_p["files"])
+                precommand_paths = changes["modified"] | changes["deleted"] | changes["unchanged"]
+        elif watcher:
+            with phases.timed("watch"):
+                changes = watcher.stop()
+                if watcher.overflowed:
+                    # Lost some events, so fall back on mtimes for what changed
+                    syslog.syslog('Missed filesystem events for %s, checking mtimes under %d root(s)' % (cmd_uuid, len(roots)))
+                    changes["modified"] |= inotify.changed_since(roots, start_ns) - changes["created"]
+
+                # The files named on the command line are still worth reporting if untouched,
+                # they're (most likely) its inputs and their hashes come from the cache
+                touched = changes["created"] | changes["modified"] | changes["deleted"]
+                changes["unchanged"] = set([p for p in watched_files if os.path.isfile(p)]) - touched
+                precommand_paths = changes["modified"] | changes["deleted"] | changes["unchanged"]
+        else:
+            with phases.timed("snapshot"):
+                postcommand = snapshot.Snapshot(token_p["dirs"], watched_files, expand_dirs=token_p["named_dirs"] | new_dirs)
+                changes = precommand.diff(postcommand)
+                precommand_paths = precommand.paths()
+        if foreign_paths:
+            # Leave changes to files belonging to blocks running alongside us for them to report
+            for change in ["created", "modified", "deleted"]:
+                changes[change] -= foreign_paths
+
+        cmd_str = " ".join(fields) # Replace cmd_str to use abspaths
+
+        # Only created and modified files need hashing, everything else is
+        # either gone or should come straight out of the hash cache
+        paths = changes["created"] | changes["modified"] | changes["deleted"] | changes["unchanged"]
+        resource_info = scan.scan_resources(paths, start_clock, precommand_paths, force_hash=force_hash, unchanged_paths=changes["unchanged"])
+
+        # Parse the output, apply any appropriate executable handlers (which can
+        # look up the digests we've just made, rather than hash anything again)
         meta = []
-        for executie_name in token_p["executables"]:
-            if cmd.can_parse_exec(executie_name):
-                parsed_meta = cmd.attempt_parse_exec(executie_name, token_p["executables"][executie_name], cmd_str, stdout, stderr)
-                meta.extend(parsed_meta)
+        with phases.timed("command_handlers"):
+            digests = scan.DigestRegistry(resource_info, start_clock)
+            for executie_name in token_p["executables"]:
+                if cmd.can_parse_exec(executie_name):
+                    parsed_meta = cmd.attempt_parse_exec(executie_name, token_p["executables"][executie_name], cmd_str, stdout.view(), stderr.view(), digests=digests)
+                    meta.extend(parsed_meta)
         meta.extend( run_meta )
 
-        # Look for changes
-        paths = set(precommand_paths).union(set(inflate_path_set(watched_dirs | watched_files)))
-        resource_info = []
-        for path in paths:
-            resource_hash = '0'
-            resource_size = 0
-            resource_exists = os.path.exists(path)
-            if resource_exists:
-                resource_hash = util.hashfile(path, start_clock, force_hash=path in precommand_paths)
-                resource_size = os.path.getsize(path)
-
-                # Run any appropriate filetype handlers IF the hash has changed
-                fmeta = []
-                if resource_hash:
-                    if cmd.can_parse_type(path):
-                        parsed_meta = cmd.attempt_parse_type(path)
-                        fmeta.extend(parsed_meta)
-
-            resource_info.append({
-                "node_uuid": util.get_node(path)[1],
-                "path": path,
-                "name": os.path.basename(path),
-                "lpath": path.split(os.path.sep)[1:-1],
-                "exists": resource_exists,
-                "precommand_exists": path in precommand_paths,
-                "hash": resource_hash,
-                "size": resource_size,
-                "metadata": fmeta,
-            })
+        if phases.OVERHEAD_META:
+            # Everything but sending this update itself
+            meta.extend(phases.overhead_meta(phases.current().report(exclude="command")))
 
         # Pretty hacky way to get the UUID cmd str
         #token_p = parse_tokens(fields, insert_uuids=True)
         #uuid_cmd_str = " ".join(token_p["fields"]) # Replace cmd_str to use abspaths
-        base.emit2("command/update", {
+        base.queue_emit("command/update", {
             "cmd_uuid": cmd_uuid,
             "return_code": return_code,
             "text": {
-                "stdout": stdout.decode('utf-8'),
-                "stderr": stderr.decode('utf-8'),
+                "stdout": stdout.text(),
+                "stderr": stderr.text(),
             },
             "resources": resource_info,
             "started_at": int(start_clock.strftime("%s")),
             "finished_at": int(end_clock.strftime("%s")),
             "metadata": meta,
         }, to_uuid=None)
+        stdout.close()
+        stderr.close()
+
+        return {
+            "return_code": return_code,
+            "resources": resource_info,
+            "changed": changes["created"] | changes["modified"],
+        }
+
+    @staticmethod
+    def skip_command(cmd_uuid, run):
+        # Record a memoized block as run, pointing at the outputs it would have made
+        timestamp = datetime.now()
+        resource_info = scan.scan_resources(run["outputs"], timestamp, set(run["outputs"]), unchanged_paths=set(run["outputs"]))
+        base.queue_emit("command/update", {
+            "cmd_uuid": cmd_uuid,
+            "return_code": run["return_code"],
+            "text": {
+                "stdout": "",
+                "stderr": "",
+            },
+            "resources": resource_info,
+            "started_at": int(timestamp.strftime("%s")),
+            "finished_at": int(timestamp.strftime("%s")),
+            "metadata": [
+                { "tag": "meta", "name": "memoized", "type": "str", "value": run["fingerprint"]},
+            ],
+        }, to_uuid=None)
 
 class Client(object):
 
-    def __init__(self):
+    def __init__(self, force_hash=False, jobs=1, memoize=False, track=None):
         self.meta = {}
+        self.depends = {}
+        self.force_hash = force_hash # ignore the local hash cache and rehash everything
+        self.jobs = jobs # run up to this many independent blocks at once
+        self.memoize = memoize # skip blocks whose inputs, command and outputs match a previous run
+        self.track = track # how to find what each block changed, defaults to TRACK_BACKEND
 
     def signal_handler(self):
         pass
 
     def parse_script(self, script_path, param_d=None):
-        if not param_d:
-            param_d = {}
-
-        def check_line(line):
-            if len(line.strip()) <= 1:
-                # Ignore lines with a single character (after strip)
-                return False
-            if line[0] == '#' and not line[1] == '@':
-                # Skip any comments that aren't meant for Chitin
-                return False
-            return True
-
-        script_lines = [l.strip() for l in open(script_path).readlines() if check_line(l)]
-
-        input_map = {}      # Map a CHITIN_INPUT parameter to a "dollar" number
-        input_meta = {}     # Store key-value pairs of metadata for display later
-
-        blocks = []         # Parsed command blocks
-        current_block = []  # Current command block to be appended to
-        in_block = False    # Flag for whether we are in or out of a block
-
-        # Read each line from the script and sort them into blocks (delimited by
-        # CHITIN_START_BLOCK and CHITIN_END_BLOCK).
-        for line in script_lines:
-            if line.startswith("#@CHITIN_START_BLOCK"):
-                if len(current_block) > 0:
-                    # Catch scenario where there is a missing CHITIN_END_BLOCK
-                    blocks.append(current_block)
-                    current_block = []
-                else:
-                    in_block = True
-
-            elif line.startswith("#@CHITIN_END_BLOCK"):
-                if len(current_block) > 0:
-                    blocks.append(current_block)
-                    current_block = []
-                in_block = False
-
-            elif line.startswith("#@CHITIN_INPUT"):
-                # Map the parameter name (defined in the script) to its dollar number
-                # We will replace all $N with the value from param_d with the matching key
-                v_fields = line.split(" ")
-                input_map[v_fields[2]] = int(v_fields[1])
-
-            elif line.startswith("#@CHITIN_META"):
-                v_fields = line.split(" ")
-                try:
-                    input_meta[v_fields[1]] = v_fields[2]
-                except IndexError:
-                    pass
-
-            else:
-                # Elsewise this is a regular script line
-                if in_block:
-                    current_block.append(line)
-                else:
-                    # Not currently in a block, so just make a new block with the current line
-                    blocks.append([line])
-
-        meta = {"script": {"path": script_path}}
-
-        # Polish blocks by adding semi-colons between multiple script lines and
-        # insert any mapped parameters to the appropriate "dollar" variable
-        command_blocks = []
-        for b in blocks:
-            BLOCK_COMMAND = "; ".join(b)
-
-            # Blindly replace variables using the parameter dictionary
-            for param_name, param_value in param_d.items():
-                try:
-                    # Look up which dollar number to replace in the bash script
-                    BLOCK_COMMAND = BLOCK_COMMAND.replace("$" + str(input_map[param_name]), str(param_value))
-                    meta["script"][param_name] = param_value
-                except KeyError:
-                    pass
-            command_blocks.append(BLOCK_COMMAND)
+        # The script is only parsed once (until it changes), each parameter set
+        # is then just substituted into the compiled blocks
+        compiled = script.compile_script(script_path)
+        command_blocks, meta = compiled.instantiate(param_d)
 
         # Update the meta dictionary for the client, this gets uploaded later
-        meta["script"].update(input_meta)
         self.meta.update(meta)
 
+        # CHITIN_DEPENDS names resolved to block indices, for execute
+        self.depends = compiled.depends
+
         return command_blocks
 
     #def exe_script(self, script, job_uuid, job_params, node="default", queue="default"): ??? how to get params to SGE...
@@ -317,9 +383,12 @@ class Client(object):
         #        print("[FAIL] Unset experiment parameter '%s'. Job NOT submitted." % p)
         #        return None
         commands_list = self.parse_script(script_path)
-        self.execute(commands_list)
+        self.execute(commands_list, depends=self.depends)
+
+    def execute(self, commands_list, depends=None):
+        if self.jobs > 1:
+            return self.execute_concurrent(commands_list, depends=depends)
 
-    def execute(self, commands_list):
         group_uuid = str(uuid.uuid4())
         for command_i, command in enumerate(commands_list):
             cmd_uuid = str(uuid.uuid4())
@@ -328,7 +397,7 @@ class Client(object):
             token_p = parse_tokens(command.split(" "))
             cmd_str = " ".join(token_p["fields"]) # cmd_str now uses abspaths
 
-            base.emit2("command/new", {
+            base.queue_emit("command/new", {
                 "cmd_uuid": cmd_uuid,
                 "group_uuid": group_uuid,
                 "cmd_str": cmd_str,
@@ -337,7 +406,89 @@ class Client(object):
             })
 
             # Run and handle command
-            ClientDaemon.run_command(cmd_uuid, cmd_str)
+            self.run_block(cmd_uuid, command, token_p)
+
+    def execute_concurrent(self, commands_list, depends=None):
+        self.execute_groups([(commands_list, depends)], jobs=self.jobs)
+
+    def execute_groups(self, groups, jobs=1):
+        """Run the blocks of one or more (commands_list, depends) groups on a
+        single pool of jobs workers. Each group gets its own group_uuid, blocks
+        within a group are ordered as execute would, groups never wait on each other."""
+        commands = []
+        token_ps = []
+        cmd_uuids = []
+        deps = {}
+        group_uuids = []
+
+        for commands_list, depends in groups:
+            group_uuid = str(uuid.uuid4())
+            group_uuids.append(group_uuid)
+            offset = len(commands)
+
+            # Collapse new command tokens to cmd_str
+            g_token_ps = [parse_tokens(command.split(" ")) for command in commands_list]
+
+            # Everything is queued up front, in script order, even though
+            # independent blocks may well finish out of order
+            for command_i, token_p in enumerate(g_token_ps):
+                cmd_uuid = str(uuid.uuid4())
+                cmd_uuids.append(cmd_uuid)
+                base.queue_emit("command/new", {
+                    "cmd_uuid": cmd_uuid,
+                    "group_uuid": group_uuid,
+                    "cmd_str": " ".join(token_p["fields"]), # cmd_str now uses abspaths
+                    "queued_at": int(datetime.now().strftime("%s")),
+                    "order": command_i,
+                })
+
+            for j, g_deps in schedule.infer_dependencies(g_token_ps, explicit=depends).items():
+                deps[offset + j] = set(offset + i for i in g_deps)
+            commands.extend(commands_list)
+            token_ps.extend(g_token_ps)
+
+        touched = []
+        for token_p in token_ps:
+            inputs, outputs, dirs = schedule.block_paths(token_p)
+            touched.append(inputs | outputs)
+        all_touched = set().union(*touched)
+
+        def run(command_i):
+            # Anything named by another block is theirs to report, even if it changes while we run
+            foreign_paths = all_touched - touched[command_i]
+            self.run_block(cmd_uuids[command_i], commands[command_i], token_ps[command_i], foreign_paths=foreign_paths)
+
+        schedule.run_blocks(len(commands), deps, run, jobs=jobs)
+        return group_uuids
+
+    def execute_sweep(self, script_path, param_sets, jobs=None):
+        """Run script_path once for each dict of parameters in param_sets, up to
+        jobs blocks at a time (across all of the runs). Returns a list of
+        (group_uuid, meta) pairs, one per parameter set."""
+        compiled = script.compile_script(script_path)
+        groups = []
+        metas = []
+        for param_d in param_sets:
+            command_blocks, meta = compiled.instantiate(param_d)
+            groups.append((command_blocks, compiled.depends))
+            metas.append(meta)
+
+        group_uuids = self.execute_groups(groups, jobs=jobs or self.jobs)
+        return list(zip(group_uuids, metas))
+
+    def run_block(self, cmd_uuid, command, token_p, foreign_paths=None):
+        cmd_str = " ".join(token_p["fields"])
+        if not self.memoize:
+            return ClientDaemon.run_command(cmd_uuid, cmd_str, force_hash=self.force_hash, foreign_paths=foreign_paths, track=self.track)
+
+        run = memo.check_run(command, token_p)
+        if run:
+            return ClientDaemon.skip_command(cmd_uuid, run)
+
+        inputs = memo.input_digests(token_p)
+        result = ClientDaemon.run_command(cmd_uuid, cmd_str, force_hash=self.force_hash, foreign_paths=foreign_paths, track=self.track)
+        memo.record_run(command, inputs, result)
+        return result
 
 
 
@@ -348,9 +499,35 @@ class Client(object):
 #        pass
 
 def exec_script():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script")
+    parser.add_argument("--force-hash", action="store_true", help="ignore the local hash cache and rehash every file")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="run up to this many independent blocks at once")
+    parser.add_argument("--memoize", action="store_true", help="skip blocks whose command, inputs and outputs are unchanged since their last successful run")
+    parser.add_argument("--track", choices=["snapshot", "inotify", "strace"], help="how to find what each block changed (default TRACK_BACKEND)")
+    args = parser.parse_args()
+
     from chitin.client import Client
-    c = Client()
-    c.execute_script(sys.argv[1])
+    c = Client(force_hash=args.force_hash, jobs=args.jobs, memoize=args.memoize, track=args.track)
+    c.execute_script(args.script)
+
+def exec_sweep():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script")
+    parser.add_argument("params", help="parameter sets, as a TSV with a header row, a JSON array of objects (.json) or JSONL (.jsonl, one object per line)")
+    parser.add_argument("--force-hash", action="store_true", help="ignore the local hash cache and rehash every file")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="run up to this many blocks at once, across all of the parameter sets")
+    parser.add_argument("--memoize", action="store_true", help="skip blocks whose command, inputs and outputs are unchanged since their last successful run")
+    parser.add_argument("--track", choices=["snapshot", "inotify", "strace"], help="how to find what each block changed (default TRACK_BACKEND)")
+    args = parser.parse_args()
+
+    from chitin.client import Client
+    c = Client(force_hash=args.force_hash, jobs=args.jobs, memoize=args.memoize, track=args.track)
+    param_sets = script.read_param_sets(args.params)
+    for group_uuid, meta in c.execute_sweep(args.script, param_sets):
+        print("%s\t%s" % (group_uuid, " ".join(["%s=%s" % (k, v) for k, v in sorted(meta["script"].items()) if k != "path"])))
 
 def cli():
     if len(sys.argv) == 1:
@@ -373,22 +550,42 @@ def cli():
             print("%s\t%s" % (resource["uuid"], resource["name"]))
 
 def notice():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--force-hash", action="store_true", help="ignore the local hash cache and rehash every file")
+    parser.add_argument("-r", "--recursive", action="store_true", help="notice everything under path, in batches, resuming an interrupted run")
+    parser.add_argument("--include", action="append", default=[], help="with -r, only notice files whose name or relative path matches this glob (repeatable)")
+    parser.add_argument("--exclude", action="append", default=[], help="with -r, skip files and dirs whose name or relative path matches this glob (repeatable)")
+    parser.add_argument("--batch-size", type=int, default=ingest.NOTICE_BATCH_SIZE, help="with -r, resources per update sent to the server")
+    parser.add_argument("--restart", action="store_true", help="with -r, ignore any interrupted run and start again")
+    args = parser.parse_args()
+
+    if args.recursive:
+        cmd_uuid, n_sent = ingest.ingest(args.path, include=args.include, exclude=args.exclude,
+                batch_size=args.batch_size, force_hash=args.force_hash, restart=args.restart,
+                cmd_str='chitin-notice -r %s' % args.path)
+        print("%s\t%d" % (cmd_uuid, n_sent))
+        return
+
     cmd_uuid = str(uuid.uuid4())
     timestamp = datetime.now()
-    base.emit2("command/new", {
+    base.queue_emit("command/new", {
         "cmd_uuid": cmd_uuid,
-        "cmd_str": 'chitin-notice %s' % sys.argv[1],
+        "cmd_str": 'chitin-notice %s' % args.path,
         "queued_at": int(timestamp.strftime("%s"))-1,
         "order": 0,
     })
     
     resource_info = []
-    for path in inflate_path_set([sys.argv[1]]):
+    for path in inflate_path_set([args.path]):
         resource_hash = '0'
+        resource_hash_alg = None
         resource_size = 0
         resource_exists = os.path.exists(path)
         if resource_exists:
-            resource_hash = util.hashfile(path, timestamp, force_hash=True)
+            resource_hash = util.hashfile(path, timestamp, halg=util.HASH_ALG, force_hash=args.force_hash)
+            resource_hash_alg = util.HASH_ALG
             resource_size = os.path.getsize(path)
 
         node_path, node_uuid = util.get_node(path)
@@ -400,9 +597,10 @@ def notice():
             "exists": resource_exists,
             "precommand_exists": True,
             "hash": resource_hash,
+            "hash_alg": resource_hash_alg,
             "size": resource_size,
         })
-    base.emit2("command/update", {
+    base.queue_emit("command/update", {
         "cmd_uuid": cmd_uuid,
         "meta": {},
         "return_code": None,
@@ -1,31 +1,239 @@
+import atexit
+import glob
+import json
+import os
+import queue
+import syslog
+import threading
+import time
+
 import requests
 from .. import conf
+from .. import phases
+
+# Messages are spooled to disk before sending, so commands can keep running
+# (and nothing is lost) if the server is slow or down
+SPOOL_DIR = os.path.expanduser(getattr(conf, "SPOOL_DIR", "~/.chitin/spool"))
+
+# Send up to BATCH_SIZE queued messages per request to the server's batch endpoint,
+# waiting up to BATCH_WAIT seconds for a batch to fill
+EMIT_BATCH = getattr(conf, "EMIT_BATCH", True)
+BATCH_SIZE = getattr(conf, "BATCH_SIZE", 50)
+BATCH_WAIT = getattr(conf, "BATCH_WAIT", 0.5)
+
+# Messages the server refuses outright (4xx) are moved here rather than retried forever
+DEAD_LETTER_DIR = os.path.expanduser(getattr(conf, "DEAD_LETTER_DIR", os.path.join(SPOOL_DIR, "dead")))
 
-# This will be a proper Queue
-MESSAGES = []
+# How long to hang around at exit for the queue to drain, anything left over
+# stays in the spool and is sent next time
+FLUSH_TIMEOUT = getattr(conf, "FLUSH_TIMEOUT", 30)
 
+# Keep connections alive between requests
+SESSION = requests.Session()
+
+def _url(base_endpoint):
+    return conf.ENDPOINT + '/ocarina/api/' + base_endpoint + '/'
+
+@phases.timed("emit")
 def emit2(base_endpoint, payload, to_uuid=None):
     if to_uuid:
         base_endpoint += ("/%s" % to_uuid)
-    print(payload)
     payload["key"] = conf.KEY
-    r = requests.post(conf.ENDPOINT + '/ocarina/api/' + base_endpoint + '/', json=payload)
-    print (r.json())
+    r = SESSION.post(_url(base_endpoint), json=payload)
     return r.json()
 
-def emit_messages():
-    for m in MESSAGES:
-        # Send message
-        # If failed, abort and wait until later
+
+class Outbox(object):
+    """A spooled queue of messages, sent to the server in order (and in batches
+    where possible) by a background thread."""
+
+    def __init__(self, spool_dir=SPOOL_DIR, dead_letter_dir=DEAD_LETTER_DIR):
+        self.spool_dir = spool_dir
+        self.dead_letter_dir = dead_letter_dir
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.pending = 0
+        self.drained = threading.Condition(self.lock)
+        self.thread = None
+        self.use_batch = EMIT_BATCH
+
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+
+    def _spool_path(self):
+        # Sortable by time, then by order of emission within this process
+        self.seq += 1
+        return os.path.join(self.spool_dir, "%020d-%d-%08d.json" % (time.time_ns(), os.getpid(), self.seq))
+
+    def put(self, base_endpoint, payload, to_uuid=None):
+        payload["key"] = conf.KEY
+        message = {"endpoint": base_endpoint, "to_uuid": to_uuid, "payload": payload}
+
+        with self.lock:
+            spool_path = self._spool_path()
+            self.pending += 1
+        with open(spool_path + ".tmp", "w") as spool_fh:
+            json.dump(message, spool_fh)
+        os.rename(spool_path + ".tmp", spool_path)
+
+        self.queue.put(spool_path)
+        self.start()
+
+    def recover(self):
+        # Pick up anything left in the spool by processes that have since died
+        for spool_path in sorted(glob.glob(os.path.join(self.spool_dir, "*.json"))):
+            try:
+                pid = int(os.path.basename(spool_path).split("-")[1])
+            except (IndexError, ValueError):
+                continue
+            if pid == os.getpid() or _pid_alive(pid):
+                continue
+
+            # Claim it by renaming it to one of ours, so nobody else sends it too
+            with self.lock:
+                claimed_path = self._spool_path()
+                self.pending += 1
+            try:
+                os.rename(spool_path, claimed_path)
+            except OSError:
+                with self.lock:
+                    self.pending -= 1
+                continue
+            self.queue.put(claimed_path)
+        self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="chitin-outbox")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + BATCH_WAIT
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        backoff = 1
+        batch = []
+        while True:
+            if not batch:
+                batch = self._next_batch()
+            try:
+                self._send(batch)
+            except Exception as e:
+                # Connection trouble or a 5xx, leave it in the spool and try again in a bit
+                syslog.syslog('Failed to send %d message(s), retrying in %ds (%s)' % (len(batch), backoff, str(e)))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+
+            backoff = 1
+            self._done(batch)
+            batch = []
+
+    def _done(self, spool_paths):
+        for spool_path in spool_paths:
+            try:
+                os.unlink(spool_path)
+            except OSError:
+                pass
+        with self.lock:
+            self.pending -= len(spool_paths)
+            self.drained.notify_all()
+
+    def _dead_letter(self, spool_path, endpoint, r):
+        # Sending it again won't change the server's mind, so put it aside for a human
+        if not os.path.exists(self.dead_letter_dir):
+            os.makedirs(self.dead_letter_dir)
+        dead_path = os.path.join(self.dead_letter_dir, os.path.basename(spool_path))
         try:
-            emit(m[0], m[1], to_uuid=m[2])
-        except:
+            os.rename(spool_path, dead_path)
+        except OSError:
             pass
+        syslog.syslog('Server refused %s message with %d, moved to %s (%s)' % (endpoint, r.status_code, dead_path, r.text[:200]))
+        with self.lock:
+            self.pending -= 1
+            self.drained.notify_all()
+
+    def _send(self, batch):
+        # Anything that raises is retried, so only do that for connection errors and 5xx
+        messages = []
+        for spool_path in batch:
+            with open(spool_path) as spool_fh:
+                messages.append(json.load(spool_fh))
 
-def queue_emit(msg):
+        if self.use_batch and len(messages) > 1:
+            r = SESSION.post(_url("batch"), json={"key": conf.KEY, "messages": messages})
+            if r.status_code == 404:
+                # The server doesn't know about batches, stop asking
+                self.use_batch = False
+            elif r.status_code >= 500:
+                r.raise_for_status()
+            elif r.status_code < 400:
+                return
+            # Otherwise something in the batch was refused, send them one at a time to find out what
+
+        while batch:
+            m = messages[0]
+            base_endpoint = m["endpoint"]
+            if m["to_uuid"]:
+                base_endpoint += ("/%s" % m["to_uuid"])
+            r = SESSION.post(_url(base_endpoint), json=m["payload"])
+            if r.status_code >= 500:
+                r.raise_for_status()
+
+            # Don't send this one again if a later message in the batch fails
+            messages.pop(0)
+            spool_path = batch.pop(0)
+            if r.status_code >= 400:
+                self._dead_letter(spool_path, base_endpoint, r)
+            else:
+                self._done([spool_path])
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Wait (up to timeout seconds) for everything queued to be sent.
+        Returns True if the queue was drained."""
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.pending > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.drained.wait(remaining)
+        return True
+
+def _pid_alive(pid):
     try:
-        MESSAGES.append( (msg[0], msg[1], msg[2]) )
-    except:
-        MESSAGES.append( (msg[0], msg[1], None) )
-    emit_messages()
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+OUTBOX = None
+_outbox_lock = threading.Lock()
+
+def get_outbox():
+    global OUTBOX
+    with _outbox_lock:
+        if OUTBOX is None:
+            OUTBOX = Outbox()
+            OUTBOX.recover()
+            atexit.register(OUTBOX.flush)
+        return OUTBOX
 
+@phases.timed("emit")
+def queue_emit(base_endpoint, payload, to_uuid=None):
+    """Like emit2, but returns straight away and leaves the sending to the
+    outbox's background thread. Use for anything that doesn't need a reply."""
+    get_outbox().put(base_endpoint, payload, to_uuid=to_uuid)
@@ -0,0 +1,199 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import conf
+
+# Where to keep the local sqlite stores, one per node (see conf.ROOTS)
+CACHE_DIR = os.path.expanduser(getattr(conf, "CACHE_DIR", "~/.chitin"))
+
+# Cap the number of entries held per store, least recently used are dropped first
+HASH_CACHE_SIZE = getattr(conf, "HASH_CACHE_SIZE", 1000000)
+METADATA_CACHE_SIZE = getattr(conf, "METADATA_CACHE_SIZE", 100000)
+
+# Don't bother checking the size of the store on every insert
+EVICT_EVERY = 1000
+
+# Nor writing a hit's last_used back unless it's at least this stale (in seconds),
+# the LRU only needs to be roughly right and a commit on every hit is not cheap
+LAST_USED_INTERVAL = 3600
+
+# Files modified this close to the time we started hashing them could be modified
+# again within the same mtime tick without it showing, so we can't trust them later
+# (cf. git's racy-clean). A few ticks of the kernel's clock is plenty for most
+# filesystems, raise it for ones with coarse timestamps (1s on ext3, 2s on FAT)
+RACY_NS = int(getattr(conf, "HASH_CACHE_RACY_MS", 20) * 1000000)
+
+
+class SqliteStore(object):
+    """A local sqlite table with an LRU last_used column, shared between
+    threads (behind our own lock) and capped at max_entries rows."""
+
+    table = None
+    schema = None
+
+    def __init__(self, db_path, max_entries):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.inserts = 0
+
+        if os.path.dirname(db_path) and not os.path.exists(os.path.dirname(db_path)):
+            os.makedirs(os.path.dirname(db_path))
+
+        # Connections are shared between hashing threads, so serialise with our own lock
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (self.table, self.schema))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS %s_lru ON %s (last_used)" % (self.table, self.table))
+        self.conn.commit()
+
+    def _inserted(self):
+        # Call with the lock held, after each insert
+        self.inserts += 1
+        if self.inserts % EVICT_EVERY == 0:
+            self._evict()
+
+    def _evict(self):
+        n = self.conn.execute("SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+        if n > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY last_used ASC LIMIT ?)" % (self.table, self.table),
+                (n - self.max_entries,)
+            )
+
+    def _touch(self, last_used, where, key):
+        # Call with the lock held, on a hit
+        now = time.time()
+        if last_used is None or now - last_used >= LAST_USED_INTERVAL:
+            self.conn.execute("UPDATE %s SET last_used=? WHERE %s" % (self.table, where), (now,) + key)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class HashCache(SqliteStore):
+    """Map (device, inode, size, mtime_ns, algorithm) to a previously computed
+    digest, so files that have not changed since we last saw them don't get
+    hashed again."""
+
+    table = "hashes"
+    schema = """
+        dev INTEGER,
+        ino INTEGER,
+        size INTEGER,
+        mtime_ns INTEGER,
+        alg TEXT,
+        digest TEXT,
+        last_used REAL,
+        PRIMARY KEY (dev, ino, size, mtime_ns, alg)
+    """
+
+    def __init__(self, db_path, max_entries=HASH_CACHE_SIZE):
+        super(HashCache, self).__init__(db_path, max_entries)
+
+    def get(self, st, alg):
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, alg)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest, last_used FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND alg=?", key
+            ).fetchone()
+            if not row:
+                return None
+            self._touch(row[1], "dev=? AND ino=? AND size=? AND mtime_ns=? AND alg=?", key)
+        return row[0]
+
+    def put(self, st, alg, digest, hashed_at_ns=None):
+        if hashed_at_ns is None:
+            hashed_at_ns = time.time_ns()
+        if hashed_at_ns - st.st_mtime_ns < RACY_NS:
+            # Too fresh to trust, we'll get it next time around
+            return
+
+        with self.lock:
+            # Any older version of this file is now stale
+            self.conn.execute("DELETE FROM hashes WHERE dev=? AND ino=? AND alg=?", (st.st_dev, st.st_ino, alg))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, alg, digest, time.time())
+            )
+            self._inserted()
+            self.conn.commit()
+
+
+class MetadataCache(SqliteStore):
+    """Map a file's content digest (and the name and version of the filetype
+    handler that looked at it) to the metadata the handler made, so the same
+    content is only ever inspected once."""
+
+    table = "metadata"
+    schema = """
+        digest TEXT,
+        handler TEXT,
+        version INTEGER,
+        metadata TEXT,
+        last_used REAL,
+        PRIMARY KEY (digest, handler, version)
+    """
+
+    def __init__(self, db_path, max_entries=METADATA_CACHE_SIZE):
+        super(MetadataCache, self).__init__(db_path, max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest, handler, version):
+        key = (digest, handler, version)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT metadata, last_used FROM metadata WHERE digest=? AND handler=? AND version=?", key
+            ).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(row[1], "digest=? AND handler=? AND version=?", key)
+        return json.loads(row[0])
+
+    def put(self, digest, handler, version, metadata):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                (digest, handler, version, json.dumps(metadata), time.time())
+            )
+            self._inserted()
+            self.conn.commit()
+
+
+_hash_caches = {}
+_hash_caches_lock = threading.Lock()
+
+def get_hash_cache(node_uuid=None):
+    """Return the (shared) HashCache for a node, opening it on first use.
+    Paths outside any of conf.ROOTS share a "default" store. Returns None if
+    the store cannot be opened."""
+    name = node_uuid or "default"
+    with _hash_caches_lock:
+        if name not in _hash_caches:
+            try:
+                _hash_caches[name] = HashCache(os.path.join(CACHE_DIR, "hashes-%s.db" % name))
+            except (sqlite3.Error, OSError):
+                # Can't write a cache here, just hash everything like we used to
+                _hash_caches[name] = None
+        return _hash_caches[name]
+
+_metadata_cache = []
+
+def get_metadata_cache():
+    """Return the (shared) MetadataCache, or None if it cannot be opened."""
+    with _hash_caches_lock:
+        if not _metadata_cache:
+            try:
+                _metadata_cache.append(MetadataCache(os.path.join(CACHE_DIR, "metadata.db")))
+            except (sqlite3.Error, OSError):
+                _metadata_cache.append(None)
+        return _metadata_cache[0]
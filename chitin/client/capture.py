@@ -0,0 +1,209 @@
+import mmap
+import os
+import sys
+import tempfile
+import threading
+
+from . import conf
+from . import util
+
+# Only this much of the start and end of each stream is sent to the server
+CAPTURE_HEAD = getattr(conf, "CAPTURE_HEAD", 65536)
+CAPTURE_TAIL = getattr(conf, "CAPTURE_TAIL", 65536)
+
+# The whole stream is spooled to a temp file (up to this many bytes) for the command handlers
+CAPTURE_SPOOL_MAX = getattr(conf, "CAPTURE_SPOOL_MAX", 1073741824) # 1GiB
+
+# Echo the command's output to our own stdout/stderr as it arrives
+CAPTURE_TEE = getattr(conf, "CAPTURE_TEE", True)
+
+READ_SIZE = 65536
+
+class StreamCapture(object):
+    """Keep tabs on one of a child's output streams without holding all of it:
+    a bounded head and tail, a byte count, a digest of the whole stream and a
+    spool file (up to CAPTURE_SPOOL_MAX) that handlers can read lines back from."""
+
+    def __init__(self, tee=None, head_bytes=CAPTURE_HEAD, tail_bytes=CAPTURE_TAIL, spool_max=CAPTURE_SPOOL_MAX):
+        self.tee = tee
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.spool_max = spool_max
+
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.n_bytes = 0
+        self.halg_name, halg = util.get_hash_algorithm()
+        self.halg = halg()
+        self.spool = tempfile.TemporaryFile()
+        self.spooled = 0
+
+    def feed(self, chunk):
+        if self.tee:
+            self.tee.write(chunk)
+            self.tee.flush()
+
+        self.halg.update(chunk)
+        self.n_bytes += len(chunk)
+
+        if len(self.head) < self.head_bytes:
+            self.head.extend(chunk[:self.head_bytes - len(self.head)])
+        self.tail.extend(chunk)
+        if len(self.tail) > self.tail_bytes:
+            del self.tail[:len(self.tail) - self.tail_bytes]
+
+        if self.spooled < self.spool_max:
+            chunk = chunk[:self.spool_max - self.spooled]
+            self.spool.write(chunk)
+            self.spooled += len(chunk)
+
+    def pump(self, fh):
+        """Feed everything from the (binary) file handle fh until EOF."""
+        fd = fh.fileno()
+        while True:
+            chunk = os.read(fd, READ_SIZE)
+            if not chunk:
+                break
+            self.feed(chunk)
+        fh.close()
+
+    @property
+    def truncated(self):
+        return self.n_bytes > self.head_bytes + self.tail_bytes
+
+    def text(self):
+        # What gets sent to the server, the whole thing if it's small enough
+        if not self.truncated:
+            body = bytes(self.head) + bytes(self.tail[max(0, len(self.tail) - (self.n_bytes - len(self.head))):])
+            return body.decode("utf-8", errors="replace")
+        return "%s\n[chitin skipped %d bytes]\n%s" % (
+            bytes(self.head).decode("utf-8", errors="replace"),
+            self.n_bytes - len(self.head) - len(self.tail),
+            bytes(self.tail).decode("utf-8", errors="replace"),
+        )
+
+    def digest(self):
+        return self.halg.hexdigest()
+
+    def lines(self):
+        """Iterate over the lines of the spooled stream, as str."""
+        self.spool.flush()
+        self.spool.seek(0)
+        for line in self.spool:
+            yield line.decode("utf-8", errors="replace")
+
+    def view(self):
+        return LineView(self)
+
+    def close(self):
+        self.spool.close()
+
+class LineView(object):
+    """Lazy access to the non-blank, stripped lines of a StreamCapture's spool,
+    for the command handlers. Nothing is read until it's asked for: head and
+    tail only touch the ends of the stream, iterating streams it line by line
+    and chunks hands out line-aligned memoryviews of the mapped spool.
+    If the stream outgrew the spool, truncated is set and iterating (and
+    chunks) stop at the last whole line that made it in. tail comes from
+    the capture's own tail, which always has the real end of the stream."""
+
+    CHUNK_SIZE = 67108864 # 64MiB
+
+    def __init__(self, capture):
+        self.capture = capture
+
+    @property
+    def truncated(self):
+        return self.capture.spooled < self.capture.n_bytes
+
+    def _mapped(self):
+        self.capture.spool.flush()
+        if self.capture.spooled == 0:
+            return None
+        return mmap.mmap(self.capture.spool.fileno(), self.capture.spooled, access=mmap.ACCESS_READ)
+
+    def __iter__(self):
+        truncated = self.truncated
+        for line in self.capture.lines():
+            if truncated and not line.endswith("\n"):
+                # Cut off by the spool limit
+                break
+            line = line.strip()
+            if line:
+                yield line
+
+    def head(self, n):
+        lines = []
+        for line in self:
+            if len(lines) == n:
+                break
+            lines.append(line)
+        return lines
+
+    def _last_lines(self, buf, n, complete):
+        # Walk back from the end of buf one line at a time, if buf doesn't
+        # start at the start of the stream its first line is only part of one
+        lines = []
+        end = len(buf)
+        while end > 0 and len(lines) < n:
+            start = buf.rfind(b"\n", 0, end) + 1
+            if start == 0 and not complete:
+                break
+            line = bytes(buf[start:end]).decode("utf-8", errors="replace").strip()
+            if line:
+                lines.append(line)
+            end = start - 1
+        return lines[::-1]
+
+    def tail(self, n):
+        tail = self.capture.tail
+        lines = self._last_lines(tail, n, len(tail) == self.capture.n_bytes)
+        if len(lines) == n or len(tail) == self.capture.n_bytes or self.truncated:
+            return lines
+        # Wanted more than the tail holds, but the spool has all of it
+        mm = self._mapped()
+        if mm is None:
+            return lines
+        with mm:
+            return self._last_lines(mm, n, True)
+
+    def chunks(self, size=CHUNK_SIZE):
+        """Yield memoryviews over the spool of about size bytes, each ending
+        on a line break (or the end of the stream). Each one is only valid
+        until the next is asked for."""
+        mm = self._mapped()
+        if mm is None:
+            return
+        with mm:
+            length = len(mm)
+            if self.truncated:
+                length = mm.rfind(b"\n") + 1
+            with memoryview(mm) as view:
+                start = 0
+                while start < length:
+                    end = mm.find(b"\n", min(start + size, length) - 1, length)
+                    end = length if end == -1 else end + 1
+                    with view[start:end] as chunk:
+                        yield chunk
+                    start = end
+
+def capture_process(proc, tee=CAPTURE_TEE, wait=True):
+    """Drain proc's stdout and stderr pipes into a pair of StreamCaptures (on
+    their own threads, so neither pipe can fill up and block the child) and
+    (unless wait is False, for callers reaping it themselves) wait for it to
+    finish. Returns (stdout, stderr)."""
+    stdout = StreamCapture(tee=getattr(sys.stdout, "buffer", None) if tee else None)
+    stderr = StreamCapture(tee=getattr(sys.stderr, "buffer", None) if tee else None)
+
+    pumps = [
+        threading.Thread(target=stdout.pump, args=(proc.stdout,)),
+        threading.Thread(target=stderr.pump, args=(proc.stderr,)),
+    ]
+    for t in pumps:
+        t.daemon = True
+        t.start()
+    for t in pumps:
+        t.join()
+    if wait:
+        proc.wait()
+    return stdout, stderr
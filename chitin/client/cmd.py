@@ -1,6 +1,10 @@
+import functools
 import re
 import os
+import syslog
 
+from . import cache
+from . import conf
 from . import handlers
 
 command_handlers = {
@@ -11,19 +15,97 @@ command_handlers = {
 filetype_handlers = {
     "bam": handlers.BamFileHandler,
     "vcf": handlers.VcfFileHandler,
+    "vcf.gz": handlers.VcfFileHandler,
+    "vcf.bgz": handlers.VcfFileHandler,
     "fa": handlers.FastaFileHandler,
+    "fa.gz": handlers.FastaFileHandler,
     "fasta": handlers.FastaFileHandler,
+    "fasta.gz": handlers.FastaFileHandler,
     "fq": handlers.FastqFileHandler,
+    "fq.gz": handlers.FastqFileHandler,
     "fastq": handlers.FastqFileHandler,
+    "fastq.gz": handlers.FastqFileHandler,
     "err": handlers.ErrFileHandler,
 }
 
-def attempt_parse_type(path):
-    if not can_parse_type(path):
+# Look inside files whose names don't give their type away
+SNIFF_FILETYPES = getattr(conf, "SNIFF_FILETYPES", False)
+SNIFF_BYTES = 65536
+
+_sniffed = {} # (dev, inode, size, mtime_ns) -> filetype
+
+@functools.lru_cache(maxsize=65536)
+def get_suffix_type(name):
+    """Match the longest (possibly compound, e.g. "fq.gz") suffix of name
+    against the filetype handlers."""
+    parts = name.lower().split('.')
+    for i in range(1, len(parts)):
+        t = ".".join(parts[i:])
+        if t in filetype_handlers:
+            return t
+    return None
+
+def sniff_type(path):
+    """Guess a filetype from the first few bytes of path (decompressing them first
+    for gzip or BGZF), cached by the file's identity."""
+    import zlib
+
+    try:
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        if key in _sniffed:
+            return _sniffed[key]
+        with open(path, "rb") as fh:
+            head = fh.read(SNIFF_BYTES)
+    except OSError:
+        return None
+
+    compressed = head[:2] == b"\x1f\x8b"
+    if compressed:
+        try:
+            head = zlib.decompressobj(31).decompress(head)
+        except zlib.error:
+            head = b""
+
+    t = None
+    if head[:4] == b"BAM\1":
+        t = "bam"
+    elif head[:16] == b"##fileformat=VCF":
+        t = "vcf"
+    elif head[:1] == b">":
+        t = "fa"
+    elif head[:1] == b"@" and not re.match(rb"^@[A-Z][A-Z]\t", head): # not a SAM header
+        t = "fq"
+    if t and compressed and t != "bam":
+        t += ".gz"
+
+    _sniffed[key] = t
+    return t
+
+def get_filetype(path):
+    t = get_suffix_type(os.path.basename(path))
+    if t is None and SNIFF_FILETYPES:
+        t = sniff_type(path)
+    return t
+
+def attempt_parse_type(path, digest=None):
+    t = get_filetype(path)
+    if not t:
         return []
+    handler = filetype_handlers[t]
 
-    t = path.lower().split('.')[-1]
-    ret = filetype_handlers[t](path).make_metadata()
+    # If we've seen this exact content before, the handler's answer won't have changed
+    # (sampled digests don't pin down the content, so don't trust those)
+    ret = None
+    mcache = None
+    if digest and "sample:" not in digest:
+        mcache = cache.get_metadata_cache()
+        if mcache:
+            ret = mcache.get(digest, handler.__name__, handler.version)
+    if ret is None:
+        ret = handler(path).make_metadata()
+        if mcache and ret:
+            mcache.put(digest, handler.__name__, handler.version, ret)
 
     return [
         #TODO Need to support more types
@@ -31,31 +113,34 @@ def attempt_parse_type(path):
     ]
 
 def attempt_integrity_type(path):
-    for t in filetype_handlers:
-        if path.lower().endswith("." + t):
-            ret = filetype_handlers[t](path).check_integrity()
-            ret["handler"] = t
-            return ret
-    return {}
+    t = get_filetype(path)
+    if not t:
+        return {}
+    ret = filetype_handlers[t](path).check_integrity()
+    ret["handler"] = t
+    return ret
 
 
 def can_parse_type(path):
-    return path.lower().split('.')[-1] in filetype_handlers
+    return get_filetype(path) is not None
 
 def can_parse_exec(exec_basename):
     return exec_basename in command_handlers
 
-def attempt_parse_exec(exec_basename, exec_path, cmd_str, stdout, stderr):
+def attempt_parse_exec(exec_basename, exec_path, cmd_str, stdout, stderr, digests=None):
     if not can_parse_exec(exec_basename):
         return {}
 
     #TODO Could check version here with new exec_path variable?
-    handled = command_handlers[exec_basename](cmd_str.split(" ")[1:], stdout, stderr)
-    handled_meta = {
-            "cmd": handled.handle_command(),
-            "stdout": handled.handle_stdout(),
-            "stderr": handled.handle_stderr(),
-    }
+    handled = command_handlers[exec_basename](cmd_str.split(" ")[1:], stdout, stderr, digests=digests)
+    handled_meta = {}
+    for key, handle in [("cmd", handled.handle_command), ("stdout", handled.handle_stdout), ("stderr", handled.handle_stderr)]:
+        # A handler tripping over odd output shouldn't cost us the command's update
+        try:
+            handled_meta[key] = handle()
+        except Exception as e:
+            syslog.syslog('%s could not handle %s of %s (%s: %s)' % (handled.__class__.__name__, key, exec_basename, e.__class__.__name__, str(e)))
+            handled_meta[key] = {}
 
     #TODO Need to support more types
     ret = []
@@ -3,11 +3,17 @@ import os
 
 class CommandHandler(object):
 
-    def __init__(self, command_tokens, stdout, stderr):
+    def __init__(self, command_tokens, stdout, stderr, digests=None):
+        # stdout and stderr are capture.LineViews, iterate them (or use head, tail
+        # or chunks) for their non-blank lines rather than reading the lot
         self.cmd_tokens = command_tokens
         self.cmd_str = " ".join(command_tokens)
-        self.stdout = [l.strip() for l in stdout.split("\n") if len(l.strip()) > 0]
-        self.stderr = [l.strip() for l in stderr.split("\n") if len(l.strip()) > 0]
+        self.stdout = stdout
+        self.stderr = stderr
+
+        # Ask digests (a scan.DigestRegistry) for the hash of any file, most
+        # will have been hashed already for the command's resources
+        self.digests = digests
 
     def handle_stderr(self):
         return {}
@@ -24,6 +30,9 @@ class CommandHandler(object):
 
 class FiletypeHandler(object):
 
+    # Bump this whenever make_metadata's output changes, so stale cached results aren't used
+    version = 1
+
     def __init__(self, path):
         self.path = path
 
@@ -48,32 +57,31 @@ class FindCommandHandler(CommandHandler):
             return {}
 
     def handle_stdout(self):
-        import os
-
-        results = 0
-        lengths = {}
+        from collections import Counter
 
-        for line in self.stdout:
-            if len(line) == 0:
-                continue
-            results += 1
+        if self.stdout.truncated:
+            # Only some of the output was spooled, any count would be short
+            return {"truncated": True}
 
-            fields = line.split(os.path.sep)
-            last = fields[-1]
-            if len(last) not in lengths:
-                lengths[len(last)] = 0
-            lengths[len(last)] += 1
+        # Histogram of basename lengths, a chunk of lines at a time
+        lengths = Counter()
+        for chunk in self.stdout.chunks():
+            text = str(chunk, "utf-8", errors="replace")
+            lengths.update([len(line.rpartition(os.path.sep)[2]) for line in map(str.strip, text.split("\n")) if line])
 
         return {
-            "results": results,
-            "lengths": lengths,
+            "results": sum(lengths.values()),
+            "lengths": dict(lengths),
         }
 
 class BowtieCommandHandler(CommandHandler):
 
     def handle_command(self):
-        import util
         import glob
+        from . import scan
+        from datetime import datetime
+
+        digests = self.digests or scan.DigestRegistry([], datetime.now())
 
         interesting = {
             "-1": "reads1",
@@ -94,12 +102,13 @@ class BowtieCommandHandler(CommandHandler):
             if field in interesting:
                 try:
                     if field == "-x":
-                        h = util.hashfiles(glob.glob(fields[field_i + 1] + "*"))
+                        # The index is a set of .bt2 (or .bt2l, for large ones) files sharing a prefix
+                        prefix = fields[field_i + 1]
+                        index_paths = glob.glob(glob.escape(prefix) + ".*.bt2") + glob.glob(glob.escape(prefix) + ".*.bt2l")
+                        h = digests.get_set(index_paths) if index_paths else 0
                     else:
-                        #h = util.get_file_record(fields[field_i + 1])["digest"]
-                        h = util.hashfile(fields[field_i + 1])
-                except:
-                    pass
+                        h = digests.get(fields[field_i + 1])
+                except (IndexError, OSError):
                     h = 0
                 meta[interesting[field]] = "%s (%s)" % (fields[field_i + 1], h)
                 skip = True
@@ -111,29 +120,193 @@ class BowtieCommandHandler(CommandHandler):
     def handle_stderr(self):
         try:
             return {
-                "alignment": float(self.stderr[-1].split("%")[0].strip())
+                "alignment": float(self.stderr.tail(1)[0].split("%")[0].strip())
             }
-        except IndexError:
+        except (IndexError, ValueError):
+            # No summary line, e.g. "(ERR): bowtie2-align exited with value 1"
             return {}
 
 ################################################################################
 
+# BAM helpers, read counts come from the BAI where there is an up to date one,
+# otherwise from a scan over the BGZF blocks (inflated on a pool of threads)
+
+BGZF_WORKERS = min(4, os.cpu_count() or 1)
+BGZF_BATCH = 64 # blocks per inflate job
+
+# The BAI "pseudo-bin" holding each reference's mapped/unmapped read counts
+BAI_PSEUDO_BIN = 37450
+
+_bam_counts = {} # (path, inode, mtime_ns) -> read count
+
+def bam_index_path(path):
+    for index_path in [path + ".bai", path[:-4] + ".bai"]:
+        if os.path.exists(index_path):
+            return index_path
+    return None
+
+def count_bai_reads(index_path):
+    """Total the mapped, unmapped and unplaced read counts recorded in a BAI.
+    Returns None if any reference is missing its pseudo-bin (older indexers
+    didn't write one), as we can't trust the total."""
+    import struct
+
+    with open(index_path, "rb") as bai_fh:
+        data = bai_fh.read()
+    if data[:4] != b"BAI\1":
+        return None
+
+    total = 0
+    pos = 4
+    n_ref = struct.unpack_from("<i", data, pos)[0]
+    pos += 4
+    for ref_i in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, pos)[0]
+        pos += 4
+        found_pseudo = n_bin == 0 # no bins, no reads
+        for bin_i in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, pos)
+            pos += 8
+            if bin_id == BAI_PSEUDO_BIN:
+                n_mapped, n_unmapped = struct.unpack_from("<QQ", data, pos + 16)
+                total += n_mapped + n_unmapped
+                found_pseudo = True
+            pos += 16 * n_chunk
+        if not found_pseudo:
+            return None
+        n_intv = struct.unpack_from("<i", data, pos)[0]
+        pos += 4 + (8 * n_intv)
+
+    # Reads with no coordinate at all, if the indexer bothered to write them
+    if len(data) >= pos + 8:
+        total += struct.unpack_from("<Q", data, pos)[0]
+    return total
+
+def _bgzf_raw_blocks(fh):
+    # Yield the raw deflate payload of each BGZF block
+    import struct
+
+    while True:
+        header = fh.read(12)
+        if len(header) < 12:
+            return
+        if header[:4] != b"\x1f\x8b\x08\x04":
+            raise ValueError("Not a BGZF file")
+        xlen = struct.unpack_from("<H", header, 10)[0]
+        extra = fh.read(xlen)
+
+        bsize = None
+        xpos = 0
+        while xpos + 4 <= len(extra):
+            si1, si2, slen = struct.unpack_from("<BBH", extra, xpos)
+            if si1 == 66 and si2 == 67:
+                bsize = struct.unpack_from("<H", extra, xpos + 4)[0]
+            xpos += 4 + slen
+        if bsize is None:
+            raise ValueError("BGZF block is missing its BSIZE")
+
+        rest = fh.read(bsize + 1 - 12 - xlen)
+        yield rest[:-8] # drop CRC32 and ISIZE
+
+def _inflate_blocks(raw_blocks):
+    import zlib
+    return b"".join([zlib.decompress(raw, -15) for raw in raw_blocks])
+
+def bgzf_chunks(path, workers=BGZF_WORKERS):
+    """Yield the decompressed contents of a BGZF file in order, inflating
+    batches of blocks in parallel (zlib releases the GIL)."""
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+
+    with open(path, "rb") as fh, ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        batch = []
+        for raw in _bgzf_raw_blocks(fh):
+            batch.append(raw)
+            if len(batch) == BGZF_BATCH:
+                in_flight.append(pool.submit(_inflate_blocks, batch))
+                batch = []
+                # Don't read (much) further ahead than we can inflate
+                while len(in_flight) > workers * 2:
+                    yield in_flight.popleft().result()
+        if batch:
+            in_flight.append(pool.submit(_inflate_blocks, batch))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def count_bam_records(chunks):
+    """Count the alignment records in the decompressed BAM stream chunks."""
+    import struct
+
+    buff = b""
+    pos = 0
+    n = 0
+    in_header = True
+    for chunk in chunks:
+        if pos >= len(buff):
+            # Still skipping the rest of a record that spanned the last chunk
+            pos -= len(buff)
+            buff = chunk
+        else:
+            buff = buff[pos:] + chunk
+            pos = 0
+
+        if in_header:
+            # magic, l_text, text, n_ref, then n_ref * (l_name, name, l_ref)
+            try:
+                if buff[:4] != b"BAM\1":
+                    raise ValueError("Not a BAM file")
+                hpos = 8 + struct.unpack_from("<i", buff, 4)[0]
+                n_ref = struct.unpack_from("<i", buff, hpos)[0]
+                hpos += 4
+                for ref_i in range(n_ref):
+                    hpos += 4 + struct.unpack_from("<i", buff, hpos)[0] + 4
+                if hpos > len(buff):
+                    continue
+            except struct.error:
+                # Header hasn't all arrived yet
+                continue
+            pos = hpos
+            in_header = False
+
+        while pos + 4 <= len(buff):
+            pos += 4 + struct.unpack_from("<i", buff, pos)[0]
+            n += 1
+
+    if pos > len(buff):
+        # Last record was truncated
+        n -= 1
+    return n
+
+def count_bam_reads(path):
+    """Count the reads in a BAM, once per version of the file."""
+    st = os.stat(path)
+    key = (path, st.st_ino, st.st_mtime_ns)
+    if key not in _bam_counts:
+        reads = None
+        index_path = bam_index_path(path)
+        if index_path and os.stat(index_path).st_mtime_ns >= st.st_mtime_ns:
+            reads = count_bai_reads(index_path)
+        if reads is None:
+            reads = count_bam_records(bgzf_chunks(path))
+        _bam_counts[key] = reads
+    return _bam_counts[key]
+
 class BamFileHandler(FiletypeHandler):
 
     def check_integrity(self):
-        from subprocess import check_output
         reads = 0
         try:
-            p = check_output("samtools view -c %s" % self.path, shell=True)
-            reads = int(p.split("\n")[0].strip())
+            reads = count_bam_reads(self.path)
         except Exception as e:
             pass
 
         has_index = False
         has_indate_index = None
-        if os.path.exists(self.path + ".bai"):
+        index_path = bam_index_path(self.path)
+        if index_path:
             has_index = True
-            if os.path.getmtime(self.path) <= os.path.getmtime(self.path + ".bai"):
+            if os.path.getmtime(self.path) <= os.path.getmtime(index_path):
                 has_indate_index = True
             else:
                 has_indate_index = False
@@ -145,21 +318,138 @@ class BamFileHandler(FiletypeHandler):
         }
 
     def make_metadata(self):
-        from subprocess import check_output
         try:
-            p = check_output("samtools view -c %s" % self.path, shell=True)
-            return {"read_n": p.split("\n")[0].strip()}
+            return {"read_n": str(count_bam_reads(self.path))}
         except:
             return {}
 
+# Streaming record counters for the text formats. Each file is read once, in
+# big chunks, (through gzip if it's gzipped or bgzipped) and the stats are
+# cached per version of the file so integrity and metadata share the pass.
+
+READ_CHUNK = 4194304 # 4MiB
+
+_text_stats = {} # (path, inode, mtime_ns, kind) -> stats
+
+def open_maybe_gzip(path):
+    import gzip
+    with open(path, "rb") as fh:
+        magic = fh.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+def read_chunks(path, size=READ_CHUNK):
+    with open_maybe_gzip(path) as fh:
+        while True:
+            chunk = fh.read(size)
+            if not chunk:
+                break
+            yield chunk
+
+def n50(lengths):
+    # lengths is a Counter of length -> number of sequences of that length
+    total = sum(l * n for l, n in lengths.items())
+    running = 0
+    for l in sorted(lengths, reverse=True):
+        running += l * lengths[l]
+        if running * 2 >= total:
+            return l
+    return 0
+
+def _seq_summary(lengths):
+    return {
+        "read_n": sum(lengths.values()),
+        "base_n": sum(l * n for l, n in lengths.items()),
+        "n50": n50(lengths),
+        "lengths": dict(lengths),
+    }
+
+def fasta_stats(chunks):
+    # Find the record starts (a ">" at the start of a line) and count the
+    # sequence bytes between them, without ever joining a record together
+    from collections import Counter
+    lengths = Counter()
+    current = None      # bases in the current record, None until the first header
+    in_header = False
+    last = b"\n"
+    for chunk in chunks:
+        starts = [0] if last == b"\n" and chunk[:1] == b">" else []
+        i = chunk.find(b"\n>")
+        while i != -1:
+            starts.append(i + 1)
+            i = chunk.find(b"\n>", i + 1)
+
+        bounds = starts + [len(chunk)]
+        segments = [(0, bounds[0], False)] + [(bounds[k], bounds[k + 1], True) for k in range(len(starts))]
+        for seg_start, seg_end, is_record in segments:
+            if is_record:
+                if current is not None:
+                    lengths[current] += 1
+                current = 0
+                in_header = True
+                seg_start += 1 # the >
+            if current is None:
+                continue
+            if in_header:
+                newline = chunk.find(b"\n", seg_start, seg_end)
+                if newline == -1:
+                    continue
+                in_header = False
+                seg_start = newline + 1
+            current += (seg_end - seg_start) - chunk.count(b"\n", seg_start, seg_end) - chunk.count(b"\r", seg_start, seg_end)
+        last = chunk[-1:]
+
+    if current is not None:
+        lengths[current] += 1
+    return _seq_summary(lengths)
+
+def fastq_stats(chunks):
+    # Assumes the usual four lines per record, sequence on the second
+    from collections import Counter
+    lengths = Counter()
+    carry = b""
+    line_i = 0
+    for chunk in chunks:
+        buff = carry + chunk
+        cut = buff.rfind(b"\n") + 1
+        carry = buff[cut:]
+        lines = buff[:cut].split(b"\n")[:-1]
+        lengths.update(map(len, lines[(1 - line_i) % 4::4]))
+        line_i = (line_i + len(lines)) % 4
+    if carry and line_i == 1:
+        lengths[len(carry)] += 1
+    return _seq_summary(lengths)
+
+def vcf_stats(chunks):
+    # Count the lines that aren't headers, without splitting anything
+    lines = 0
+    headers = 0
+    last = b"\n"
+    for chunk in chunks:
+        lines += chunk.count(b"\n")
+        headers += chunk.count(b"\n#") + (1 if last == b"\n" and chunk[:1] == b"#" else 0)
+        last = chunk[-1:]
+    if last not in (b"\n", b""):
+        lines += 1 # no trailing newline
+    return {"variant_n": lines - headers}
+
+def text_stats(path, kind):
+    """Run the kind ("fasta", "fastq" or "vcf") counter over path, once per
+    version of the file."""
+    st = os.stat(path)
+    key = (path, st.st_ino, st.st_mtime_ns, kind)
+    if key not in _text_stats:
+        counter = {"fasta": fasta_stats, "fastq": fastq_stats, "vcf": vcf_stats}[kind]
+        _text_stats[key] = counter(read_chunks(path))
+    return _text_stats[key]
+
 class VcfFileHandler(FiletypeHandler):
 
     def check_integrity(self):
-        from subprocess import check_output
         variants = 0
         try:
-            p = check_output("grep -vc '^#' %s" % self.path, shell=True)
-            variants = p.split("\n")[0].strip()
+            variants = text_stats(self.path, "vcf")["variant_n"]
         except Exception as e:
             pass
 
@@ -168,37 +458,33 @@ class VcfFileHandler(FiletypeHandler):
         }
 
     def make_metadata(self):
-        from subprocess import check_output
         try:
-            p = check_output("grep -vc '^#' %s" % self.path, shell=True)
-            return {"snp_n": p.split("\n")[0].strip()}
+            return {"snp_n": str(text_stats(self.path, "vcf")["variant_n"])}
         except:
             return {}
 
 class FastaFileHandler(FiletypeHandler):
+    kind = "fasta"
 
     def check_integrity(self):
+        reads = 0
+        try:
+            reads = text_stats(self.path, self.kind)["read_n"]
+        except Exception as e:
+            pass
+
         return {
-            ("not_empty", "is empty"): os.path.getsize(self.path) > 0,
+            ("not_empty", "is empty"): reads > 0,
         }
 
     def make_metadata(self):
-        from subprocess import check_output
         try:
-            p = check_output("grep -c '^>' %s" % self.path, shell=True)
-            return {"read_n": p.split("\n")[0].strip()}
+            return {k: str(v) for k, v in text_stats(self.path, self.kind).items()}
         except:
             return {}
 
-class FastqFileHandler(FiletypeHandler):
-
-    def check_integrity(self):
-        return {
-            ("not_empty", "is empty"): os.path.getsize(self.path) > 0,
-        }
-
-    def make_metadata(self):
-        return {}
+class FastqFileHandler(FastaFileHandler):
+    kind = "fastq"
 
 
 class ErrFileHandler(FiletypeHandler):
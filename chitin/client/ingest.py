@@ -0,0 +1,157 @@
+import fnmatch
+import hashlib
+import json
+import os
+import syslog
+import uuid
+from datetime import datetime
+
+from .api import base
+from . import cache
+from . import conf
+from . import scan
+from . import snapshot
+from . import util
+from . import walk
+
+# How many resources to send to the server in each command/update
+NOTICE_BATCH_SIZE = getattr(conf, "NOTICE_BATCH_SIZE", 1000)
+
+def journal_path(root):
+    return os.path.join(cache.CACHE_DIR, "notice", "%s.journal" % hashlib.sha1(root.encode("utf-8")).hexdigest())
+
+class Journal(object):
+    """An append-only record of the files an ingest has already sent, so an
+    interrupted run can carry on where it stopped. The first line holds the
+    run's settings (and the cmd_uuid to keep sending to), every other line
+    is a path and the stat_key it had when it was hashed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.done = {} # path -> stat_key
+        if os.path.exists(path):
+            with open(path) as journal_fh:
+                for i, line in enumerate(journal_fh):
+                    if i == 0:
+                        self.header = json.loads(line)
+                        continue
+                    try:
+                        p, key = line.rstrip("\n").rsplit("\t", 1)
+                        self.done[p] = tuple(json.loads(key))
+                    except ValueError:
+                        # Cut off half way through a write, it'll just be sent again
+                        pass
+        self.fh = None
+
+    def start(self, header):
+        d = os.path.dirname(self.path)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        self.header = header
+        self.done = {}
+        with open(self.path, "w") as journal_fh:
+            journal_fh.write(json.dumps(header) + "\n")
+
+    def is_done(self, path, st):
+        return self.done.get(path) == snapshot.stat_key(st)
+
+    def record(self, entries):
+        # entries are (path, stat_key), fsync'd so a crash can't lose a batch we've queued
+        if self.fh is None:
+            self.fh = open(self.path, "a")
+        for path, key in entries:
+            self.fh.write("%s\t%s\n" % (path, json.dumps(list(key))))
+            self.done[path] = key
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def finish(self):
+        if self.fh:
+            self.fh.close()
+        os.unlink(self.path)
+
+def matches(rel_path, patterns):
+    name = os.path.basename(rel_path)
+    return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+def find_files(root, include=None, exclude=None):
+    """Yield (path, stat) for every file under root whose name or path
+    (relative to root) matches one of include (everything if none are given)
+    and none of exclude. Excluded names also stop the walk going into dirs."""
+    include = include or []
+    exclude = exclude or []
+    for entry, depth in walk.walk(root, ignore=walk.IGNORE + exclude):
+        rel_path = os.path.relpath(entry.path, root)
+        if exclude and matches(rel_path, exclude):
+            continue
+        if include and not matches(rel_path, include):
+            continue
+        try:
+            yield entry.path, entry.stat()
+        except OSError:
+            pass
+
+def ingest(root, include=None, exclude=None, batch_size=NOTICE_BATCH_SIZE, force_hash=False, restart=False, cmd_str=None):
+    """Notice every matching file under root: hash them in parallel and send
+    them to the server batch_size at a time, journalling each batch once it's
+    queued. A run that is interrupted picks up where it stopped next time
+    (unless restart is set). Returns (cmd_uuid, number of files sent)."""
+    root = os.path.abspath(root)
+    settings = {"root": root, "include": include or [], "exclude": exclude or []}
+    journal = Journal(journal_path(root))
+
+    timestamp = datetime.now()
+    if journal.header and not restart and all(journal.header.get(k) == v for k, v in settings.items()):
+        cmd_uuid = journal.header["cmd_uuid"]
+        syslog.syslog('Resuming notice of %s (%d files already sent)' % (root, len(journal.done)))
+    else:
+        cmd_uuid = str(uuid.uuid4())
+        header = dict(settings)
+        header["cmd_uuid"] = cmd_uuid
+        journal.start(header)
+        base.queue_emit("command/new", {
+            "cmd_uuid": cmd_uuid,
+            "cmd_str": cmd_str or 'chitin-notice %s' % root,
+            "queued_at": int(timestamp.strftime("%s"))-1,
+            "order": 0,
+        })
+
+    n_sent = 0
+    batch = []
+    def send(batch):
+        paths = [path for path, key in batch]
+        resource_info = scan.scan_resources(paths, timestamp, set(paths), force_hash=force_hash, unchanged_paths=set(paths))
+        for resource in resource_info:
+            node_path, node_uuid = util.get_node(resource["path"])
+            resource["lpath"] = node_path.split(os.path.sep)[1:-1]
+
+        base.queue_emit("command/update", {
+            "cmd_uuid": cmd_uuid,
+            "meta": {},
+            "return_code": None,
+            "text": {
+                "stdout": "",
+                "stderr": "",
+            },
+            "resources": resource_info,
+            "started_at": int(timestamp.strftime("%s")),
+            "finished_at": int(datetime.now().strftime("%s")),
+        }, to_uuid=None)
+        # Spooled by the outbox now, so safe to skip next time
+        journal.record(batch)
+
+    for path, st in find_files(root, include=include, exclude=exclude):
+        if journal.is_done(path, st):
+            continue
+        batch.append((path, snapshot.stat_key(st)))
+        if len(batch) >= batch_size:
+            send(batch)
+            n_sent += len(batch)
+            batch = []
+    if batch:
+        send(batch)
+        n_sent += len(batch)
+
+    journal.finish()
+    return cmd_uuid, n_sent
@@ -0,0 +1,262 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import stat as stat_module
+import struct
+import syslog
+import threading
+
+from . import conf
+from . import walk
+
+# How run_command finds out what a command changed: "snapshot" stats the files named
+# on the command line and the dirs around them before and after, "inotify" watches
+# the same dirs, plus INOTIFY_ROOTS, for the changes as they happen and "strace"
+# runs the command under strace to see exactly which files it opened
+TRACK_BACKEND = getattr(conf, "TRACK_BACKEND", "snapshot")
+
+# The dirs a command names (and the cwd) are watched this many levels of subdirs
+# deep, as the snapshots look at them. Only INOTIFY_ROOTS are watched further down
+# (INOTIFY_MAX_DEPTH levels, None for all of them)
+INOTIFY_DIR_DEPTH = getattr(conf, "INOTIFY_DIR_DEPTH", 1)
+INOTIFY_ROOTS = getattr(conf, "INOTIFY_ROOTS", [])
+INOTIFY_MAX_DEPTH = getattr(conf, "INOTIFY_MAX_DEPTH", None)
+
+# Give up (and take snapshots instead) rather than set more watches than this
+INOTIFY_MAX_WATCHES = getattr(conf, "INOTIFY_MAX_WATCHES", 8192)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# The first thing we hear about a path tells us whether it was there before the command
+APPEARED = IN_CREATE | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len
+READ_SIZE = 65536
+
+_libc = []
+
+def _get_libc():
+    if not _libc:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError):
+            libc = None
+        _libc.append(libc)
+    return _libc[0]
+
+def available():
+    return _get_libc() is not None
+
+class InotifyError(Exception):
+    pass
+
+def _deeper(a, b):
+    # Levels of subdirs, where None is all of them
+    if a is None or b is None:
+        return None
+    return max(a, b)
+
+class InotifyWatcher(object):
+    """Watch the directories under a set of (root, max_depth) pairs with inotify
+    while a command runs, to find exactly which files it created, modified and
+    deleted. New directories are watched (and their contents counted as
+    created) as they appear. If the kernel's event queue overflows, or there
+    are more than max_watches dirs to watch once it has started, the results
+    can't be trusted, which is flagged with overflowed. Too many to start
+    with raises InotifyError."""
+
+    def __init__(self, roots, ignore=None, max_watches=INOTIFY_MAX_WATCHES):
+        self.libc = _get_libc()
+        if not self.libc:
+            raise InotifyError("inotify is not available")
+
+        self.ignore = ignore
+        self.max_watches = max_watches
+        self.wds = {}          # wd -> (dir path, levels of subdirs still to watch below it)
+        self.existed = {}      # path -> whether it existed before the command (from its first event)
+        self.overflowed = False
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise InotifyError("inotify_init1 failed (%s)" % os.strerror(e))
+
+        try:
+            for root, max_depth in roots:
+                self._watch_tree(root, max_depth, created=False)
+        except InotifyError:
+            os.close(self.fd)
+            raise
+
+        self.stop_r, self.stop_w = os.pipe()
+        self.thread = threading.Thread(target=self._run, name="chitin-inotify")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _add_watch(self, path, left):
+        if len(self.wds) >= self.max_watches:
+            raise InotifyError("more than %d dirs to watch" % self.max_watches)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # Gone already, or not ours to watch
+                return None
+            # ENOSPC means we've hit fs.inotify.max_user_watches
+            raise InotifyError("inotify_add_watch %s failed (%s)" % (path, os.strerror(e)))
+        if wd in self.wds:
+            # Already watched (as part of another root), keep whichever goes deeper
+            left = _deeper(left, self.wds[wd][1])
+        self.wds[wd] = (path, left)
+        return wd
+
+    def _watch_tree(self, root, max_depth, created=False):
+        # Watch root and the dirs under it, max_depth levels down. For a dir that has just
+        # been created, anything already in it was made after we started, so note it as created
+        stack = [(root, max_depth)]
+        while stack:
+            path, left = stack.pop()
+            if self._add_watch(path, left) is None:
+                continue
+            files, dirs = walk.list_dir(path, ignore=self.ignore)
+            if created:
+                for entry in files:
+                    self.existed.setdefault(entry.path, False)
+            if left is None or left > 0:
+                for entry in dirs:
+                    if not entry.is_symlink():
+                        stack.append((entry.path, None if left is None else left - 1))
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        if mask & IN_IGNORED:
+            self.wds.pop(wd, None)
+            return
+        if wd not in self.wds or not name or walk.is_ignored(name, self.ignore):
+            return
+        parent, left = self.wds[wd]
+        path = os.path.join(parent, name)
+
+        if mask & IN_ISDIR:
+            if mask & APPEARED and (left is None or left > 0):
+                try:
+                    self._watch_tree(path, None if left is None else left - 1, created=True)
+                except InotifyError as e:
+                    syslog.syslog('Could not watch %s (%s)' % (path, str(e)))
+                    self.overflowed = True
+            return
+
+        if path not in self.existed:
+            self.existed[path] = not (mask & APPEARED)
+
+    def _drain(self):
+        while True:
+            try:
+                buf = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return
+            if not buf:
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size
+                name = buf[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                self._handle(wd, mask, os.fsdecode(name))
+
+    def _run(self):
+        while True:
+            readable, _, _ = select.select([self.fd, self.stop_r], [], [])
+            if self.fd in readable:
+                self._drain()
+            if self.stop_r in readable:
+                break
+
+    def stop(self):
+        """Stop watching and return created, modified and deleted sets of
+        file paths (in the same shape as Snapshot.diff, less unchanged)."""
+        os.write(self.stop_w, b"x")
+        self.thread.join()
+        self._drain() # anything that arrived after the thread's last look
+        os.close(self.stop_r)
+        os.close(self.stop_w)
+        os.close(self.fd)
+
+        created = set()
+        modified = set()
+        deleted = set()
+        for path, existed in self.existed.items():
+            st = walk.stat(path)
+            exists = st is not None and not stat_module.S_ISDIR(st.st_mode)
+            if existed and exists:
+                modified.add(path)
+            elif existed:
+                deleted.add(path)
+            elif exists:
+                created.add(path)
+            # Made and removed again while the command ran (a temp file), nothing to report
+        return {
+            "created": created,
+            "modified": modified,
+            "deleted": deleted,
+        }
+
+def _under(path, d):
+    return path == d or path.startswith(d + os.sep)
+
+def watch_roots(token_p, extra_roots=INOTIFY_ROOTS, dir_depth=INOTIFY_DIR_DEPTH, extra_depth=INOTIFY_MAX_DEPTH):
+    """The (dir, max_depth) pairs to watch for a command: those it names
+    (including the cwd) dir_depth levels down, the parents of the files it
+    names or might create (just the dir itself) and extra_roots extra_depth
+    levels down."""
+    roots = {}
+    def add(root, max_depth):
+        if root in roots:
+            max_depth = _deeper(max_depth, roots[root])
+        roots[root] = max_depth
+
+    for path in set(token_p["files"]) | set(token_p["maybe_files"]):
+        add(os.path.dirname(path), 0)
+    for d in token_p["named_dirs"]:
+        add(d, dir_depth)
+    for r in extra_roots:
+        add(os.path.abspath(os.path.expanduser(r)), extra_depth)
+    roots = [(r, max_depth) for r, max_depth in sorted(roots.items()) if os.path.isdir(r)]
+
+    # Everything under a root that's watched all the way down is watched anyway
+    everything = [r for r, max_depth in roots if max_depth is None]
+    return [(r, max_depth) for r, max_depth in roots if not any(_under(r, other) for other in everything if other != r)]
+
+def changed_since(roots, since_ns):
+    """Files under the (root, max_depth) pairs modified at or after since_ns,
+    for when the event queue has overflowed and the events can't be relied on."""
+    changed = set()
+    for root, max_depth in roots:
+        for entry, depth in walk.walk(root, max_depth=max_depth):
+            try:
+                if entry.stat().st_mtime_ns >= since_ns:
+                    changed.add(entry.path)
+            except OSError:
+                pass
+    return changed
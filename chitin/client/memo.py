@@ -0,0 +1,157 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+from . import cache
+from . import conf
+from . import util
+from . import walk
+
+RUN_LEDGER_SIZE = getattr(conf, "RUN_LEDGER_SIZE", 100000)
+
+# How many levels of subdirs of a named dir count as the block's inputs, as the
+# snapshots look at them (so find /data doesn't hash the whole of /data)
+MEMO_DIR_DEPTH = getattr(conf, "MEMO_DIR_DEPTH", 1)
+
+class RunLedger(cache.SqliteStore):
+    """Remember the inputs and outputs (and their digests) of the last
+    successful run of each command, so an identical re-run can be skipped."""
+
+    table = "runs"
+    schema = """
+        command_key TEXT PRIMARY KEY,
+        cmd_str TEXT,
+        return_code INTEGER,
+        inputs TEXT,
+        outputs TEXT,
+        finished_at REAL,
+        last_used REAL
+    """
+
+    def __init__(self, db_path, max_entries=RUN_LEDGER_SIZE):
+        super(RunLedger, self).__init__(db_path, max_entries)
+
+    def get(self, command_key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT cmd_str, return_code, inputs, outputs, finished_at, last_used FROM runs WHERE command_key=?", (command_key,)
+            ).fetchone()
+            if not row:
+                return None
+            self._touch(row[5], "command_key=?", (command_key,))
+        return {
+            "cmd_str": row[0],
+            "return_code": row[1],
+            "inputs": json.loads(row[2]),
+            "outputs": json.loads(row[3]),
+            "finished_at": row[4],
+        }
+
+    def put(self, command_key, cmd_str, return_code, inputs, outputs):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (command_key, cmd_str, return_code, json.dumps(inputs), json.dumps(outputs), time.time(), time.time())
+            )
+            self._inserted()
+            self.conn.commit()
+
+_ledger = []
+
+def get_ledger():
+    """Return the (shared) RunLedger, or None if it cannot be opened."""
+    with cache._hash_caches_lock:
+        if not _ledger:
+            try:
+                _ledger.append(RunLedger(os.path.join(cache.CACHE_DIR, "runs.db")))
+            except Exception:
+                _ledger.append(None)
+        return _ledger[0]
+
+def normalise(command):
+    # Use the command as written (plus where it's run from) rather than the
+    # abspath'd fields, which change as soon as its outputs exist
+    return "%s\0%s" % (os.path.abspath("."), " ".join(command.split()))
+
+def command_key(command):
+    return hashlib.sha256(normalise(command).encode("utf-8")).hexdigest()
+
+def input_paths(token_p):
+    """Every file the block could be reading: the files and executables it
+    names, the files behind any prefixes it names (e.g. bowtie2's -x idx for
+    idx.1.bt2 and friends) and the files in the dirs it names (and their
+    subdirs, MEMO_DIR_DEPTH levels down)."""
+    paths = set(token_p["files"]) | set(token_p["executables"].values())
+    for prefix in token_p["maybe_files"]:
+        paths.update([p for p in glob.glob(glob.escape(prefix) + ".*") if os.path.isfile(p)])
+
+    # The cwd is always watched, but only counts if it was actually named
+    cwd = os.path.abspath(".")
+    for d in token_p["named_dirs"]:
+        if d == cwd and cwd not in token_p["fields"]:
+            continue
+        paths.update([entry.path for entry, depth in walk.walk(d, max_depth=MEMO_DIR_DEPTH)])
+    return paths
+
+def input_digests(token_p, exclude=None):
+    """Digest the block's inputs (see input_paths, they should mostly come
+    straight out of the hash cache), skipping anything in exclude."""
+    digests = {}
+    for path in input_paths(token_p):
+        if exclude and path in exclude:
+            continue
+        try:
+            digests[path] = [util.HASH_ALG, util.hashfile(path, None)]
+        except OSError:
+            pass
+    return digests
+
+def fingerprint(command, inputs):
+    # The command and the content of everything it reads
+    fp = hashlib.sha256(normalise(command).encode("utf-8"))
+    for path in sorted(inputs):
+        fp.update(("\0%s\0%s:%s" % (path, inputs[path][0], inputs[path][1])).encode("utf-8"))
+    return fp.hexdigest()
+
+def check_run(command, token_p):
+    """Return the ledger entry (with its fingerprint) for the last successful
+    run of this block, if its inputs are the same now and all of its outputs
+    still exist unchanged. Otherwise None."""
+    ledger = get_ledger()
+    if not ledger:
+        return None
+    run = ledger.get(command_key(command))
+    if not run or run["return_code"] != 0:
+        return None
+
+    for path, (alg, digest) in run["outputs"].items():
+        if not os.path.exists(path):
+            return None
+        try:
+            if util.hashfile(path, None, halg=alg) != digest:
+                return None
+        except ValueError:
+            # Recorded with a hash algorithm that isn't available any more
+            return None
+
+    # Outputs from last time exist now, so don't mistake them for inputs
+    inputs = input_digests(token_p, exclude=run["outputs"])
+    if inputs != run["inputs"]:
+        return None
+    run["fingerprint"] = fingerprint(command, inputs)
+    return run
+
+def record_run(command, inputs, result):
+    """Put a finished run in the ledger, given the input digests from before
+    it ran and the summary returned by ClientDaemon.run_command."""
+    ledger = get_ledger()
+    if not ledger or result["return_code"] != 0:
+        return
+    outputs = {}
+    for resource in result["resources"]:
+        if resource["path"] in result["changed"] and resource["exists"]:
+            outputs[resource["path"]] = [resource["hash_alg"], resource["hash"]]
+    inputs = {path: digest for path, digest in inputs.items() if path not in outputs}
+    ledger.put(command_key(command), normalise(command), result["return_code"], inputs, outputs)
@@ -0,0 +1,105 @@
+import contextlib
+import os
+import syslog
+import threading
+import time
+
+from . import conf
+
+# Add chitin's own timings (as "overhead" tagged meta) to each command/update
+OVERHEAD_META = getattr(conf, "OVERHEAD_META", False)
+
+# Set CHITIN_PROFILE to a directory to dump a cProfile (pstats) file there for each command
+PROFILE_ENV = "CHITIN_PROFILE"
+
+_local = threading.local()
+
+class PhaseTimer(object):
+    """Accumulates how long (and how many times) each named phase of a
+    command's handling took. Activate it for the current thread and anything
+    wrapped in timed() (or passed to add()) is counted against it."""
+
+    def __init__(self):
+        self.phases = {} # name -> [seconds, count]
+        self.start_time = time.perf_counter()
+
+    def add(self, name, seconds, count=1):
+        if name not in self.phases:
+            self.phases[name] = [0.0, 0]
+        self.phases[name][0] += seconds
+        self.phases[name][1] += count
+
+    @contextlib.contextmanager
+    def active(self):
+        previous = getattr(_local, "timer", None)
+        _local.timer = self
+        try:
+            yield self
+        finally:
+            _local.timer = previous
+
+    def report(self, exclude=None):
+        """Return the phase timings in ms, along with the total time since the
+        timer was made and how much of that wasn't spent in the exclude phase
+        (i.e. the command itself)."""
+        total = time.perf_counter() - self.start_time
+        excluded = self.phases[exclude][0] if exclude in self.phases else 0.0
+        return {
+            "phases": dict((name, {"ms": int(s * 1000), "n": n}) for name, (s, n) in self.phases.items()),
+            "total_ms": int(total * 1000),
+            "overhead_ms": int((total - excluded) * 1000),
+        }
+
+def current():
+    return getattr(_local, "timer", None)
+
+def add(name, seconds, count=1):
+    timer = current()
+    if timer:
+        timer.add(name, seconds, count)
+
+@contextlib.contextmanager
+def timed(name):
+    # Works as a decorator too
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start_time)
+
+@contextlib.contextmanager
+def profiled(label):
+    """cProfile the block into $CHITIN_PROFILE/<label>.prof, if it is set."""
+    profile_dir = os.environ.get(PROFILE_ENV)
+    if not profile_dir:
+        yield
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        try:
+            if not os.path.exists(profile_dir):
+                os.makedirs(profile_dir)
+            profiler.dump_stats(os.path.join(profile_dir, "%s.prof" % label))
+        except OSError as e:
+            syslog.syslog('Could not write profile for %s (%s)' % (label, str(e)))
+
+def overhead_meta(report):
+    meta = [
+        { "tag": "overhead", "name": "total_ms", "type": "int", "value": str(report["total_ms"])},
+        { "tag": "overhead", "name": "overhead_ms", "type": "int", "value": str(report["overhead_ms"])},
+    ]
+    for name in sorted(report["phases"]):
+        meta.append({ "tag": "overhead", "name": name + "_ms", "type": "int", "value": str(report["phases"][name]["ms"])})
+    return meta
+
+def log_report(label, report):
+    syslog.syslog('Overhead for %s: %dms of %dms (%s)' % (
+        label, report["overhead_ms"], report["total_ms"],
+        ", ".join(["%s %dms/%d" % (name, p["ms"], p["n"]) for name, p in sorted(report["phases"].items())])
+    ))
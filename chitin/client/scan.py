@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import threading
+import time
+import syslog
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from . import cache
+from . import cmd
+from . import conf
+from . import phases
+from . import util
+
+# How many paths to hash at once, and whether to use threads or processes to do it.
+# hashlib releases the GIL on large buffers so threads are usually enough,
+# use "process" if the filetype handlers turn out to be the bottleneck
+HASH_WORKERS = getattr(conf, "HASH_WORKERS", min(4, os.cpu_count() or 1))
+HASH_EXECUTOR = getattr(conf, "HASH_EXECUTOR", "thread")
+
+def _process_pool(max_workers):
+    # Forked workers would inherit the hash cache's sqlite connections (and any lock
+    # another thread holds at the time), so start them from a clean forkserver
+    # instead, or spawn them where there isn't one. Each opens its own connections
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+EXECUTORS = {
+    "thread": ThreadPoolExecutor,
+    "process": _process_pool,
+}
+
+def scan_resource(path, start_clock, precommand_exists=False, force_hash=False, unchanged=False):
+    """Hash, stat and run any filetype handlers over a single path, returning
+    its resource_info entry and a (worker, bytes, seconds, handler seconds)
+    tuple for accounting.
+    Paths known to be unchanged skip the filetype handlers, and their hash
+    should come out of the hash cache rather than being read again."""
+    start_time = time.time()
+
+    resource_hash = '0'
+    resource_hash_alg = None
+    resource_size = 0
+    resource_exists = os.path.exists(path)
+    handler_secs = 0.0
+    fmeta = []
+    if resource_exists:
+        resource_hash = util.hashfile(path, start_clock, halg=util.HASH_ALG, force_hash=force_hash)
+        resource_hash_alg = util.HASH_ALG
+        resource_size = os.path.getsize(path)
+
+        # Run any appropriate filetype handlers IF the hash has changed
+        if resource_hash != '0' and not unchanged:
+            if cmd.can_parse_type(path):
+                handler_start = time.time()
+                parsed_meta = cmd.attempt_parse_type(path, digest="%s:%s" % (resource_hash_alg, resource_hash))
+                fmeta.extend(parsed_meta)
+                handler_secs = time.time() - handler_start
+
+    resource = {
+        "node_uuid": util.get_node(path)[1],
+        "path": path,
+        "name": os.path.basename(path),
+        "lpath": path.split(os.path.sep)[1:-1],
+        "exists": resource_exists,
+        "precommand_exists": precommand_exists,
+        "hash": resource_hash,
+        "hash_alg": resource_hash_alg,
+        "size": resource_size,
+        "metadata": fmeta,
+    }
+    worker = "%d:%s" % (os.getpid(), threading.current_thread().name)
+    return resource, (worker, resource_size, time.time() - start_time, handler_secs)
+
+def _scan_resource_job(job):
+    # Executor.map only hands over one argument (and it must be picklable for processes)
+    return scan_resource(*job)
+
+@phases.timed("scan")
+def scan_resources(paths, start_clock, precommand_paths, force_hash=False, unchanged_paths=None, workers=HASH_WORKERS, executor=HASH_EXECUTOR):
+    """Fan scan_resource out over paths on a pool of workers. Resources are
+    returned sorted by path, regardless of the order the workers finish in."""
+    if unchanged_paths is None:
+        unchanged_paths = set()
+    jobs = [(path, start_clock, path in precommand_paths, force_hash, path in unchanged_paths) for path in sorted(paths)]
+
+    if workers <= 1 or len(jobs) <= 1:
+        results = [_scan_resource_job(job) for job in jobs]
+    else:
+        with EXECUTORS[executor](max_workers=workers) as pool:
+            # map yields in submission order, which keeps the payload deterministic
+            results = list(pool.map(_scan_resource_job, jobs))
+
+    report_throughput([r[1] for r in results])
+    # Summed over the workers, so these can add up to more than the scan itself
+    handler_secs = sum([r[1][3] for r in results])
+    phases.add("filetype_handlers", handler_secs, len(results))
+    phases.add("hash", sum([r[1][2] for r in results]) - handler_secs, len(results))
+    mcache = cache.get_metadata_cache()
+    if mcache:
+        syslog.syslog('Metadata cache %d hits, %d misses' % (mcache.hits, mcache.misses))
+    return [r[0] for r in results]
+
+class DigestRegistry(object):
+    """The digests of the files a command touched (from its resource_info),
+    for the command handlers to look up rather than hash files again. Files
+    the command didn't touch are hashed (through the hash cache) on demand."""
+
+    def __init__(self, resources, start_clock, halg=None):
+        self.start_clock = start_clock
+        self.halg = halg or util.HASH_ALG
+        self.digests = {}
+        for resource in resources:
+            if resource["exists"] and resource["hash_alg"] == self.halg:
+                self.digests[resource["path"]] = resource["hash"]
+
+    def known(self, path):
+        return self.digests.get(os.path.abspath(path))
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        if path not in self.digests:
+            self.digests[path] = util.hashfile(path, self.start_clock, halg=self.halg)
+        return self.digests[path]
+
+    def get_set(self, paths):
+        # One digest for a group of files, hashing any we haven't seen in parallel
+        return util.hashfiles([os.path.abspath(p) for p in paths], self.start_clock, halg=self.halg, lookup=self.known, workers=HASH_WORKERS)
+
+def report_throughput(stats):
+    per_worker = {}
+    for worker, n_bytes, seconds, handler_seconds in stats:
+        if worker not in per_worker:
+            per_worker[worker] = [0, 0, 0.0]
+        per_worker[worker][0] += 1
+        per_worker[worker][1] += n_bytes
+        per_worker[worker][2] += seconds
+
+    for worker in sorted(per_worker):
+        n_files, n_bytes, seconds = per_worker[worker]
+        rate = (float(n_bytes) / 1e+6) / seconds if seconds > 0 else 0.0
+        syslog.syslog('Worker %s scanned %d files (%.2fGB in %.2fs, %.1fMB/s)' % (worker, n_files, float(n_bytes) / 1e+9, seconds, rate))
+    return per_worker
@@ -0,0 +1,110 @@
+import glob
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# >, >>, 2>, &> and friends, with the target either attached or as the next field
+REDIRECT_RE = re.compile(r"^(?:\d*|&)>>?\|?(.*)$")
+
+def looks_like_path(token):
+    # 0.5, 1,1 and 10 are arguments, not files that are about to be made
+    try:
+        float(token)
+        return False
+    except ValueError:
+        pass
+    return any(c.isalpha() or c in "/_~" for c in token)
+
+def block_paths(token_p):
+    """Guess the paths a block could read or write from its parse_tokens output,
+    returning (inputs, outputs, dirs). Inputs are the files that are already
+    there, outputs the file names that aren't yet (and anything it redirects into).
+    Tokens that are clearly not paths (flags, shell operators, numbers,
+    executables) are left out so they don't look like shared files."""
+    cwd = os.path.abspath(".")
+    fields = token_p["fields"]
+
+    outputs = set()
+    for field_i, field in enumerate(fields):
+        m = REDIRECT_RE.match(field)
+        if not m:
+            continue
+        target = m.group(1) or (fields[field_i + 1] if field_i + 1 < len(fields) else "")
+        target = target.rstrip(";")
+        if target and not target.startswith("&"):
+            outputs.add(os.path.abspath(target))
+
+    inputs = set()
+    for field_i, abspath, had_semicolon in token_p["maybe_fields"]:
+        token = fields[field_i].rstrip(";")
+        if token.startswith("-") or not looks_like_path(token):
+            continue
+        if token in token_p["executables"]:
+            continue
+        if "." not in token and os.sep not in token or glob.glob(glob.escape(abspath) + ".*"):
+            # A bare word (bwa's mem) or an index prefix (bowtie2's -x idx), read not made
+            inputs.add(abspath)
+        else:
+            outputs.add(abspath)
+
+    inputs = (inputs | set(token_p["files"])) - outputs
+
+    # Everything is run from (and watches) the cwd, that alone doesn't make a dependency
+    dirs = set(token_p["named_dirs"]) - {cwd}
+    return inputs, outputs, dirs
+
+def _under(path, d):
+    return path == d or path.startswith(d + os.sep)
+
+def conflicts(a, b):
+    """Whether block b has to wait for block a: b writes something a reads
+    or writes, or reads something a writes. Reading the same files (or
+    listing the same dirs) is fine."""
+    a_inputs, a_outputs, a_dirs = a
+    b_inputs, b_outputs, b_dirs = b
+    if b_outputs & (a_inputs | a_outputs) or b_inputs & a_outputs:
+        return True
+    # A named dir is read as a whole, so anything the other block writes under it counts
+    for d in a_dirs:
+        if any(_under(p, d) for p in b_outputs):
+            return True
+    for d in b_dirs:
+        if any(_under(p, d) for p in a_outputs):
+            return True
+    return False
+
+def infer_dependencies(token_ps, explicit=None):
+    """Map each block index to the set of earlier blocks it has to wait for.
+    Blocks where one could write what the other reads or writes run in
+    script order, blocks with an explicit (#@CHITIN_DEPENDS) entry use that instead."""
+    if explicit is None:
+        explicit = {}
+    touched = [block_paths(token_p) for token_p in token_ps]
+
+    deps = {}
+    for j in range(len(token_ps)):
+        if j in explicit:
+            deps[j] = set(i for i in explicit[j] if i < j)
+            continue
+        deps[j] = set(i for i in range(j) if conflicts(touched[i], touched[j]))
+    return deps
+
+def run_blocks(n_blocks, deps, run, jobs=1):
+    """Call run(i) for each block, at most jobs at a time, starting each
+    as soon as everything it depends on has finished."""
+    done = set()
+    started = set()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        running = {}
+        while len(done) < n_blocks:
+            for i in range(n_blocks):
+                if i in started or len(running) >= max(1, jobs):
+                    continue
+                if deps.get(i, set()) <= done:
+                    running[pool.submit(run, i)] = i
+                    started.add(i)
+
+            finished, pending = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                done.add(running.pop(future))
+                future.result() # let any exceptions out
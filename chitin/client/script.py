@@ -0,0 +1,188 @@
+import csv
+import json
+import os
+import re
+import threading
+
+# $N or ${N}, the whole number is the parameter (so $10 is never $1 followed by a 0)
+PLACEHOLDER_RE = re.compile(r"\$\{(\d+)\}|\$(\d+)")
+
+class CompiledScript(object):
+    """A chitin script parsed into its blocks, ready to have parameters
+    substituted. Each block is kept as a list of literal strings and
+    (dollar number, original text) placeholders, so instantiating it is a
+    single join rather than a search and replace per parameter."""
+
+    def __init__(self, script_path, blocks, input_map, input_meta, block_names, block_depends):
+        self.script_path = script_path
+        self.blocks = [compile_block(b) for b in blocks]
+        self.input_map = input_map          # CHITIN_INPUT parameter name -> dollar number
+        self.input_meta = input_meta        # CHITIN_META key-value pairs
+        self.block_names = block_names      # CHITIN_START_BLOCK name -> block index
+        self.block_depends = block_depends  # block index -> names from its CHITIN_DEPENDS
+
+        # Resolve CHITIN_DEPENDS names to block indices once, for execute
+        self.depends = {}
+        for block_i, names in block_depends.items():
+            self.depends[block_i] = set([block_names[name] for name in names if name in block_names])
+
+    def instantiate(self, param_d=None):
+        """Return (command_blocks, meta) for one set of parameters."""
+        if not param_d:
+            param_d = {}
+
+        meta = {"script": {"path": self.script_path}}
+        values = {}
+        for param_name, param_value in param_d.items():
+            if param_name in self.input_map:
+                values[self.input_map[param_name]] = str(param_value)
+                meta["script"][param_name] = param_value
+        meta["script"].update(self.input_meta)
+
+        command_blocks = []
+        for parts in self.blocks:
+            command_blocks.append("".join([
+                p if isinstance(p, str) else values.get(p[0], p[1]) for p in parts
+            ]))
+        return command_blocks, meta
+
+def compile_block(lines):
+    # Join the block's lines with semi-colons and split it around its placeholders,
+    # leaving (number, text) tuples where the parameters go
+    command = "; ".join(lines)
+    parts = []
+    last = 0
+    for m in PLACEHOLDER_RE.finditer(command):
+        if m.start() > last:
+            parts.append(command[last:m.start()])
+        parts.append((int(m.group(1) or m.group(2)), m.group(0)))
+        last = m.end()
+    if last < len(command):
+        parts.append(command[last:])
+    return parts
+
+def check_line(line):
+    if len(line.strip()) <= 1:
+        # Ignore lines with a single character (after strip)
+        return False
+    if line[0] == '#' and not line[1] == '@':
+        # Skip any comments that aren't meant for Chitin
+        return False
+    return True
+
+def parse(script_path):
+    """Read script_path and sort its lines into blocks (delimited by
+    CHITIN_START_BLOCK and CHITIN_END_BLOCK), returning a CompiledScript."""
+    input_map = {}      # Map a CHITIN_INPUT parameter to a "dollar" number
+    input_meta = {}     # Store key-value pairs of metadata for display later
+
+    blocks = []         # Parsed command blocks
+    current_block = []  # Current command block to be appended to
+    in_block = False    # Flag for whether we are in or out of a block
+
+    block_names = {}    # Map a CHITIN_START_BLOCK name to its block index
+    block_depends = {}  # Map a block index to the block names from its CHITIN_DEPENDS
+    pending = {"name": None, "depends": None}
+
+    def append_block(block):
+        if pending["name"]:
+            block_names[pending["name"]] = len(blocks)
+        if pending["depends"] is not None:
+            block_depends[len(blocks)] = pending["depends"]
+        pending["name"] = None
+        pending["depends"] = None
+        blocks.append(block)
+
+    with open(script_path) as script_fh:
+        for line in script_fh:
+            if not check_line(line):
+                continue
+            line = line.strip()
+
+            if line.startswith("#@CHITIN_START_BLOCK"):
+                if len(current_block) > 0:
+                    # Catch scenario where there is a missing CHITIN_END_BLOCK
+                    append_block(current_block)
+                    current_block = []
+                else:
+                    in_block = True
+                # Blocks can be named, for other blocks to CHITIN_DEPENDS on
+                v_fields = line.split(" ")
+                if len(v_fields) > 1:
+                    pending["name"] = v_fields[1]
+
+            elif line.startswith("#@CHITIN_END_BLOCK"):
+                if len(current_block) > 0:
+                    append_block(current_block)
+                    current_block = []
+                in_block = False
+
+            elif line.startswith("#@CHITIN_DEPENDS"):
+                # Names of the blocks the current (or next) block must wait for,
+                # replaces any dependencies guessed from the block's paths
+                pending["depends"] = (pending["depends"] or []) + line.split(" ")[1:]
+
+            elif line.startswith("#@CHITIN_INPUT"):
+                # Map the parameter name (defined in the script) to its dollar number
+                # We will replace all $N with the value from param_d with the matching key
+                v_fields = line.split(" ")
+                input_map[v_fields[2]] = int(v_fields[1])
+
+            elif line.startswith("#@CHITIN_META"):
+                v_fields = line.split(" ")
+                try:
+                    input_meta[v_fields[1]] = v_fields[2]
+                except IndexError:
+                    pass
+
+            else:
+                # Elsewise this is a regular script line
+                if in_block:
+                    current_block.append(line)
+                else:
+                    # Not currently in a block, so just make a new block with the current line
+                    append_block([line])
+
+    return CompiledScript(script_path, blocks, input_map, input_meta, block_names, block_depends)
+
+_compiled = {} # script abspath -> ((mtime_ns, size), CompiledScript)
+_compiled_lock = threading.Lock()
+
+def compile_script(script_path):
+    """Return the CompiledScript for script_path, only parsing it again if
+    the file has changed since last time."""
+    abspath = os.path.abspath(script_path)
+    st = os.stat(abspath)
+    key = (st.st_mtime_ns, st.st_size)
+    with _compiled_lock:
+        hit = _compiled.get(abspath)
+        if hit and hit[0] == key:
+            return hit[1]
+
+    compiled = parse(script_path)
+    with _compiled_lock:
+        _compiled[abspath] = (key, compiled)
+    return compiled
+
+def read_param_sets(path):
+    """Read parameter sets for a sweep, one dict per set, from a JSON array of
+    objects (.json), a JSONL file with one object per line (.jsonl) or a TSV
+    whose first row names the parameters."""
+    param_sets = []
+    with open(path) as param_fh:
+        if path.endswith(".json"):
+            text = param_fh.read()
+            try:
+                loaded = json.loads(text)
+            except ValueError:
+                # JSONL under a .json name, as these used to be read
+                loaded = [json.loads(line) for line in text.splitlines() if line.strip()]
+            param_sets = loaded if isinstance(loaded, list) else [loaded]
+        elif path.endswith(".jsonl"):
+            for line in param_fh:
+                if line.strip():
+                    param_sets.append(json.loads(line))
+        else:
+            for row in csv.DictReader(param_fh, delimiter="\t"):
+                param_sets.append(row)
+    return param_sets
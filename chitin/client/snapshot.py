@@ -0,0 +1,78 @@
+import os
+import stat as stat_module
+
+from . import walk
+
+def stat_key(st):
+    # Enough to tell whether a file has changed without reading it
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+class Snapshot(object):
+    """Record the stat of every file in a set of watched dirs (one level deep)
+    and watched files, so we can tell what a command changed without hashing
+    anything. Dirs in expand_dirs also have their subdirs watched."""
+
+    def __init__(self, dirs=None, files=None, expand_dirs=None):
+        self.entries = {}   # file path -> stat_key
+        self.dirs = set()   # dirs whose files we recorded
+
+        dirs = set(dirs or [])
+        for d in (expand_dirs or []):
+            dirs.update(self._scan_dir(d))
+
+        for d in dirs:
+            self._scan_dir(d)
+
+        for path in (files or []):
+            if path in self.entries:
+                continue
+            st = walk.stat(path)
+            if st and not stat_module.S_ISDIR(st.st_mode):
+                self.entries[path] = stat_key(st)
+
+    def _scan_dir(self, path):
+        # Record the files in path and return its subdirs
+        if path in self.dirs:
+            return []
+        self.dirs.add(path)
+
+        files, dirs = walk.list_dir(path)
+        for entry in files:
+            try:
+                self.entries[entry.path] = stat_key(entry.stat())
+            except OSError:
+                # Gone before we got to it
+                pass
+        return [entry.path for entry in dirs]
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def paths(self):
+        return set(self.entries)
+
+    def diff(self, after):
+        """Compare this (pre-command) snapshot with a later one, returning
+        created, modified, deleted and unchanged sets of paths."""
+        created = set()
+        modified = set()
+        unchanged = set()
+        for path, key in after.entries.items():
+            if path not in self.entries:
+                created.add(path)
+            elif self.entries[path] != key:
+                modified.add(path)
+            else:
+                unchanged.add(path)
+
+        deleted = set()
+        for path in self.entries:
+            if path not in after.entries and not os.path.exists(path):
+                deleted.add(path)
+
+        return {
+            "created": created,
+            "modified": modified,
+            "deleted": deleted,
+            "unchanged": unchanged,
+        }
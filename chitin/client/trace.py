@@ -0,0 +1,310 @@
+import codecs
+import ctypes
+import ctypes.util
+import os
+import re
+import shutil
+import stat as stat_module
+import struct
+import subprocess
+import threading
+import time
+
+from . import conf
+from . import walk
+
+# The strace to run commands under when tracking with "strace"
+STRACE = getattr(conf, "STRACE", "strace")
+
+# Paths under these aren't worth reporting (libraries, config, devices, ...)
+STRACE_IGNORE_PREFIXES = getattr(conf, "STRACE_IGNORE_PREFIXES", [
+    "/proc/", "/sys/", "/dev/", "/run/", "/etc/", "/usr/", "/lib/", "/lib64/", "/bin/", "/sbin/",
+])
+
+STRACE_ARGS = [
+    "-f",                       # follow children
+    "-qq",                      # no attach/exit chatter
+    "-y",                       # print the paths behind fds
+    "-s", "65535",              # don't truncate path strings
+    "-e", "trace=%file,fchdir,%process",
+    "-e", "signal=none",
+]
+
+LINE_RE = re.compile(r"^(\d+)\s+(.*)$")
+CALL_RE = re.compile(r"^(\w+)\((.*)\)\s+=\s+(-?\d+|\?)(<.*>)?")
+UNFINISHED = " <unfinished ...>"
+RESUMED_RE = re.compile(r"^<\.\.\. (\w+) resumed>\s?(.*)$")
+FD_PATH_RE = re.compile(r"^(?:\w+|-?\d+)<(.*)>$")
+
+WRITE_FLAGS = ["O_WRONLY", "O_RDWR", "O_CREAT", "O_TRUNC", "O_APPEND"]
+CLONES = ["clone", "clone3", "fork", "vfork"]
+
+AT_FDCWD = -100
+STATX_BTIME = 0x00000800
+STATX_SIZE = 256
+STATX_BTIME_OFFSET = 80 # struct statx_timestamp stx_btime: s64 tv_sec, u32 tv_nsec
+
+_libc = []
+
+def _get_libc():
+    if not _libc:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.statx
+        except (OSError, AttributeError):
+            libc = None
+        _libc.append(libc)
+    return _libc[0]
+
+def birth_ns(path):
+    """When path was created (in ns since the epoch), if the kernel and
+    filesystem can tell us (statx, Linux 4.11+), else None."""
+    libc = _get_libc()
+    if not libc:
+        return None
+    buf = ctypes.create_string_buffer(STATX_SIZE)
+    if libc.statx(AT_FDCWD, os.fsencode(path), 0, STATX_BTIME, buf) != 0:
+        return None
+    if not struct.unpack_from("I", buf.raw, 0)[0] & STATX_BTIME:
+        return None
+    sec, nsec = struct.unpack_from("qI", buf.raw, STATX_BTIME_OFFSET)
+    return sec * 1000000000 + nsec
+
+# The kernel stamps files from a coarse clock, which can run a tick or two behind
+# time_ns(), so anything born this close to the start counts as made by the command
+TIMESTAMP_SLACK_NS = 20 * 1000000
+
+_probed = []
+
+def available():
+    """Whether strace is installed and actually allowed to trace (ptrace is often
+    blocked in containers, or by kernel.yama.ptrace_scope), found out once by
+    tracing true. If it isn't, running a command under it would just fail."""
+    if not _probed:
+        ok = False
+        if shutil.which(STRACE):
+            try:
+                ok = subprocess.run(
+                    [STRACE] + STRACE_ARGS + ["-o", os.devnull, "--", "true"],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30,
+                ).returncode == 0
+            except (OSError, subprocess.SubprocessError):
+                ok = False
+        _probed.append(ok)
+    return _probed[0]
+
+def command(cmd_str, output_path):
+    """The argv to run cmd_str (through the shell, as Popen(shell=True) would)
+    under strace, writing the trace to output_path."""
+    return [STRACE] + STRACE_ARGS + ["-o", output_path, "--", "/bin/sh", "-c", cmd_str]
+
+def split_args(args):
+    # Split strace's rendering of a call's arguments on its top level commas
+    out = []
+    depth = 0
+    in_str = False
+    current = []
+    i = 0
+    while i < len(args):
+        c = args[i]
+        if in_str:
+            current.append(c)
+            if c == "\\" and i + 1 < len(args):
+                current.append(args[i + 1])
+                i += 1
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+            current.append(c)
+        elif c in "[{(<":
+            depth += 1
+            current.append(c)
+        elif c in "]})>":
+            depth -= 1
+            current.append(c)
+        elif c == "," and depth == 0:
+            out.append("".join(current).strip())
+            current = []
+        else:
+            current.append(c)
+        i += 1
+    if current:
+        out.append("".join(current).strip())
+    return out
+
+def unquote(arg):
+    # "a\"b\x00" -> a"b and so on, None if arg isn't a string
+    if len(arg) < 2 or arg[0] != '"':
+        return None
+    end = arg.rfind('"')
+    raw = codecs.escape_decode(arg[1:end].encode("utf-8"))[0]
+    return os.fsdecode(raw)
+
+def fd_path(arg):
+    # 3</some/path> or AT_FDCWD</some/path> (with -y) -> /some/path
+    m = FD_PATH_RE.match(arg)
+    return m.group(1) if m else None
+
+class TraceParser(object):
+    """Follow a strace -f -y log line by line (as it is written), keeping
+    track of each process's cwd and which paths were read, written and
+    deleted. Only calls that succeeded count."""
+
+    def __init__(self, cwd, start_ns=None):
+        self.root_cwd = cwd
+        self.start_ns = start_ns or time.time_ns()
+        self.cwds = {}          # pid -> cwd
+        self.unfinished = {}    # pid -> the start of a call strace split in two
+        self.last_cloner = None # children can show up before their parent's clone returns
+        self.first = {}         # path -> whether it existed before the command, from its first access
+        self.read = set()
+        self.written = set()
+        self.deleted = set()
+
+    def _cwd(self, pid):
+        if pid not in self.cwds:
+            self.cwds[pid] = self.cwds.get(self.last_cloner, self.root_cwd)
+        return self.cwds[pid]
+
+    def _resolve(self, pid, path, dirfd=None):
+        if os.path.isabs(path):
+            return os.path.normpath(path)
+        base = (fd_path(dirfd) if dirfd else None) or self._cwd(pid)
+        return os.path.normpath(os.path.join(base, path))
+
+    def _existed(self, path, default):
+        # Opening with O_CREAT (or renaming over) doesn't say whether the file was
+        # there, so look at it: if it was born (or last changed) well before the command
+        # started it was there already. Gone again by the time we've parsed this far
+        # and there's nothing to look at, so fall back on the default
+        st = walk.stat(path)
+        if st is None:
+            return default
+        before_ns = self.start_ns - TIMESTAMP_SLACK_NS
+        if st.st_ctime_ns < before_ns:
+            return True
+        born = birth_ns(path)
+        if born is None:
+            return default
+        return born < before_ns
+
+    def _saw(self, path, existed, kind):
+        if path not in self.first:
+            self.first[path] = self._existed(path, False) if existed is None else existed
+        getattr(self, kind).add(path)
+
+    def feed(self, line):
+        m = LINE_RE.match(line.rstrip("\n"))
+        if not m:
+            return
+        pid, rest = int(m.group(1)), m.group(2)
+
+        if rest.endswith(UNFINISHED):
+            self.unfinished[pid] = rest[:-len(UNFINISHED)]
+            if rest.split("(", 1)[0] in CLONES:
+                self.last_cloner = pid
+            return
+        r = RESUMED_RE.match(rest)
+        if r:
+            rest = self.unfinished.pop(pid, r.group(1) + "(") + r.group(2)
+
+        c = CALL_RE.match(rest)
+        if not c:
+            return
+        name, args, ret, ret_path = c.group(1), split_args(c.group(2)), c.group(3), c.group(4)
+        if ret == "?" or int(ret) < 0:
+            return
+        try:
+            self._call(pid, name, args, int(ret), ret_path[1:-1] if ret_path else None)
+        except (IndexError, TypeError, ValueError):
+            # Not what we expected, better to miss it than fall over
+            pass
+
+    def _call(self, pid, name, args, ret, ret_path):
+        if name in CLONES:
+            self.cwds[ret] = self._cwd(pid)
+
+        elif name == "chdir":
+            self.cwds[pid] = self._resolve(pid, unquote(args[0]))
+        elif name == "fchdir":
+            self.cwds[pid] = fd_path(args[0]) or self._cwd(pid)
+
+        elif name in ["open", "openat", "openat2", "creat"]:
+            if name == "creat":
+                path_arg, flags = args[0], "O_CREAT"
+            elif name == "open":
+                path_arg, flags = args[0], args[1]
+            else:
+                path_arg, flags = args[1], args[2]
+            # With -y the returned fd tells us exactly what was opened
+            path = ret_path or self._resolve(pid, unquote(path_arg), dirfd=args[0] if name.startswith("openat") else None)
+            if "O_DIRECTORY" in flags:
+                return
+            if any(f in flags for f in WRITE_FLAGS):
+                if "O_EXCL" in flags:
+                    self._saw(path, False, "written")
+                else:
+                    self._saw(path, None if "O_CREAT" in flags else True, "written")
+            else:
+                self._saw(path, True, "read")
+
+        elif name in ["execve", "execveat"]:
+            path = self._resolve(pid, unquote(args[0] if name == "execve" else args[1]), dirfd=args[0] if name == "execveat" else None)
+            self._saw(path, True, "read")
+
+        elif name in ["unlink", "unlinkat"]:
+            if name == "unlink":
+                path = self._resolve(pid, unquote(args[0]))
+            else:
+                if "AT_REMOVEDIR" in args[2]:
+                    return
+                path = self._resolve(pid, unquote(args[1]), dirfd=args[0])
+            self._saw(path, True, "deleted")
+
+        elif name in ["rename", "renameat", "renameat2"]:
+            if name == "rename":
+                src, dst = self._resolve(pid, unquote(args[0])), self._resolve(pid, unquote(args[1]))
+            else:
+                src, dst = self._resolve(pid, unquote(args[1]), dirfd=args[0]), self._resolve(pid, unquote(args[3]), dirfd=args[2])
+            self._saw(src, True, "deleted")
+            self._saw(dst, None, "written")
+
+        elif name in ["truncate"]:
+            self._saw(self._resolve(pid, unquote(args[0])), True, "written")
+
+    def follow(self, fh):
+        for line in fh:
+            self.feed(line)
+
+    def changes(self, named_files=None):
+        """Turn what was seen into created, modified, deleted and unchanged
+        sets of files (as Snapshot.diff does), leaving out ignored paths,
+        dirs and files that came and went while the command ran. Files
+        that were only read, and named_files, count as unchanged."""
+        named_files = set(named_files or [])
+        changes = {"created": set(), "modified": set(), "deleted": set(), "unchanged": set()}
+        touched = self.written | self.deleted
+        for path in touched | self.read | named_files:
+            if any(path.startswith(p) for p in STRACE_IGNORE_PREFIXES) or walk.is_ignored(os.path.basename(path)):
+                continue
+            st = walk.stat(path)
+            if st and stat_module.S_ISDIR(st.st_mode):
+                continue
+            # Anything named on the command line (and found by parse_tokens) was there
+            existed = path in named_files or self.first.get(path, True)
+
+            if path not in touched:
+                if st:
+                    changes["unchanged"].add(path)
+            elif st:
+                changes["modified" if existed else "created"].add(path)
+            elif existed:
+                changes["deleted"].add(path)
+        return changes
+
+def follow_in_thread(parser, fh):
+    t = threading.Thread(target=parser.follow, args=(fh,), name="chitin-strace")
+    t.daemon = True
+    t.start()
+    return t
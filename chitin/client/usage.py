@@ -0,0 +1,111 @@
+import os
+import threading
+
+from . import conf
+
+# How often (in seconds) to read /proc/<pid>/io for a running command's process tree
+USAGE_SAMPLE_INTERVAL = getattr(conf, "USAGE_SAMPLE_INTERVAL", 0.5)
+
+IO_FIELDS = ["rchar", "wchar", "read_bytes", "write_bytes"]
+
+def _children(pid):
+    # Needs CONFIG_PROC_CHILDREN, which any recent kernel has
+    kids = []
+    try:
+        for tid in os.listdir("/proc/%d/task" % pid):
+            with open("/proc/%d/task/%s/children" % (pid, tid)) as children_fh:
+                kids.extend([int(k) for k in children_fh.read().split()])
+    except (OSError, ValueError):
+        pass
+    return kids
+
+def process_tree(pid):
+    tree = []
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(_children(p))
+    return tree
+
+def read_io(pid):
+    """Return the IO_FIELDS counters from /proc/<pid>/io as a dict, or None
+    if they can't be read (gone, not ours, or not Linux)."""
+    counters = {}
+    try:
+        with open("/proc/%d/io" % pid) as io_fh:
+            for line in io_fh:
+                k, v = line.split(":", 1)
+                if k in IO_FIELDS:
+                    counters[k] = int(v)
+    except (OSError, ValueError):
+        return None
+    return counters
+
+class ProcessMonitor(object):
+    """Sample the I/O counters of a process and its descendants on a background
+    thread. The counters only ever go up, so the totals are the sum of the last
+    value seen for each pid; I/O done by a short lived child after our last
+    look at it (or by one we never saw at all) is missed."""
+
+    def __init__(self, pid, interval=USAGE_SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.last_seen = {} # (pid, starttime) -> counters, pids get reused
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="chitin-usage-%d" % pid)
+        self.thread.daemon = True
+        self.available = os.path.exists("/proc/%d/io" % pid)
+        if self.available:
+            self.thread.start()
+
+    def _starttime(self, pid):
+        try:
+            with open("/proc/%d/stat" % pid) as stat_fh:
+                return stat_fh.read().rsplit(")", 1)[1].split()[19]
+        except (OSError, IndexError):
+            return None
+
+    def sample(self):
+        for pid in process_tree(self.pid):
+            counters = read_io(pid)
+            if counters:
+                self.last_seen[(pid, self._starttime(pid))] = counters
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop sampling and return the summed counters (or None if /proc isn't there)."""
+        self.stopped.set()
+        if not self.available:
+            return None
+        self.thread.join()
+        totals = dict((k, 0) for k in IO_FIELDS)
+        for counters in self.last_seen.values():
+            for k in counters:
+                totals[k] += counters[k]
+        return totals
+
+def wait(proc):
+    """Reap proc with os.wait4 (setting its returncode, as Popen.wait would)
+    and return the rusage of it and all of the descendants it waited for."""
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+def usage_meta(wall_s, rusage, io):
+    """Turn a command's wall time, rusage and summed I/O counters into meta entries."""
+    meta = [
+        { "tag": "meta", "name": "wall_ms", "type": "int", "value": str(int(wall_s * 1000))},
+        { "tag": "meta", "name": "cpu_user_ms", "type": "int", "value": str(int(rusage.ru_utime * 1000))},
+        { "tag": "meta", "name": "cpu_sys_ms", "type": "int", "value": str(int(rusage.ru_stime * 1000))},
+        { "tag": "meta", "name": "max_rss_kb", "type": "int", "value": str(rusage.ru_maxrss)}, # KiB on Linux
+    ]
+    if io:
+        meta.extend([
+            { "tag": "meta", "name": "io_" + k, "type": "int", "value": str(io[k])} for k in IO_FIELDS
+        ])
+    return meta
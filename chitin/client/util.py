@@ -1,8 +1,12 @@
 import hashlib
-import math
+import struct
 from datetime import datetime
 import os
+import threading
+import time
+from . import cache
 from . import conf
+from . import walk
 import syslog
 syslog.openlog('chitind')
 
@@ -12,83 +16,295 @@ def get_node(path):
             return (path.replace(k, ''), conf.ROOTS[k])
     return None
 
-def hashfile(path, start_clock, halg=hashlib.md5, bs=65536, force_hash=False, partial_limit=10737418240, partial_sample=0.2):
+class ExecutableIndex(object):
+    """Index the names of everything in each PATH dir, so finding an executable
+    is a dict lookup rather than a walk over PATH for every token. Call refresh
+    once per batch of lookups, it rebuilds the index only if PATH or the mtime
+    of one of its dirs has changed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path_env = None
+        self.mtimes = None
+        self.candidates = {}    # name -> [paths] in PATH order
+        self.resolved = {}      # name -> path (or None), filled in on lookup
+
+    def _mtimes(self, dirs):
+        mtimes = []
+        for d in dirs:
+            st = walk.stat(d)
+            mtimes.append(st.st_mtime_ns if st else None)
+        return mtimes
+
+    def refresh(self):
+        path_env = os.environ.get("PATH", os.defpath)
+        dirs = [d for d in path_env.split(os.pathsep) if d]
+        mtimes = self._mtimes(dirs)
+
+        with self.lock:
+            if path_env == self.path_env and mtimes == self.mtimes:
+                return self
+
+            candidates = {}
+            for d in dirs:
+                files, subdirs = walk.list_dir(d, ignore=[])
+                for entry in files:
+                    candidates.setdefault(entry.name, []).append(entry.path)
+            self.candidates = candidates
+            self.resolved = {}
+            self.path_env = path_env
+            self.mtimes = mtimes
+        return self
+
+    def which(self, name):
+        if os.sep in name:
+            return None
+        with self.lock:
+            if name not in self.resolved:
+                self.resolved[name] = None
+                for path in self.candidates.get(name, []):
+                    if os.path.isfile(path) and os.access(path, os.X_OK):
+                        self.resolved[name] = path
+                        break
+            return self.resolved[name]
+
+EXECUTABLES = ExecutableIndex()
+
+def get_executable_index():
+    # The shared index, checked for staleness
+    return EXECUTABLES.refresh()
+
+# Set HASH_CACHE = False in conf to always hash everything
+USE_HASH_CACHE = getattr(conf, "HASH_CACHE", True)
+
+# Hash algorithms we know how to use, by the name that gets sent with each resource's hash.
+# blake2b is always available, the faster ones only if their modules are installed
+HASH_ALGORITHMS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+}
+try:
+    import blake3
+    HASH_ALGORITHMS["blake3"] = blake3.blake3
+except ImportError:
+    pass
+try:
+    import xxhash
+    HASH_ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+def best_hash_algorithm():
+    for name in ["blake3", "xxh3_128", "blake2b"]:
+        if name in HASH_ALGORITHMS:
+            return name
+
+# Set HASH_ALG in conf to pin an algorithm (e.g. "md5" to match older histories)
+HASH_ALG = getattr(conf, "HASH_ALG", None) or best_hash_algorithm()
+
+def get_hash_algorithm(halg=None):
+    """Resolve halg (None for the configured default, a name from HASH_ALGORITHMS,
+    or a hashlib-style constructor) to a (name, constructor) pair."""
+    if halg is None:
+        halg = HASH_ALG
+    if isinstance(halg, str):
+        try:
+            return halg, HASH_ALGORITHMS[halg]
+        except KeyError:
+            raise ValueError("Unknown or unavailable hash algorithm '%s' (try one of %s)" % (halg, ", ".join(sorted(HASH_ALGORITHMS))))
+    return halg().name, halg
+
+# Read buffers grow with the file, from MIN_BLOCK_SIZE up to MAX_BLOCK_SIZE
+MIN_BLOCK_SIZE = 1048576 # 1MiB
+MAX_BLOCK_SIZE = 16777216 # 16MiB
+
+# Tell the kernel to drop pages behind us for files at least this big, so
+# hashing a huge BAM doesn't push out the page cache running jobs depend on.
+# Smaller files are left alone as they're probably hot outputs about to be read again.
+FADVISE_DONTNEED_MIN = getattr(conf, "FADVISE_DONTNEED_MIN", 1073741824) # 1GiB
+
+def adaptive_block_size(size):
+    bs = MIN_BLOCK_SIZE
+    while bs < MAX_BLOCK_SIZE and bs * 64 < size:
+        bs *= 2
+    return bs
+
+def _fadvise(fd, offset, length, advice):
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+def hash_stream(f, halg, bs, dontneed=False):
+    """Feed everything left in the raw (unbuffered) file f through halg,
+    reusing a single bs sized buffer. Returns the number of bytes hashed."""
+    buff = bytearray(bs)
+    view = memoryview(buff)
+    fd = f.fileno()
+    if hasattr(os, "POSIX_FADV_SEQUENTIAL"):
+        _fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    b_hashed = 0
+    b_dropped = 0
+    while True:
+        n = f.readinto(buff)
+        if not n:
+            break
+        halg.update(view[:n])
+        b_hashed += n
+
+        if dontneed and hasattr(os, "POSIX_FADV_DONTNEED") and b_hashed - b_dropped >= MAX_BLOCK_SIZE:
+            _fadvise(fd, b_dropped, b_hashed - b_dropped, os.POSIX_FADV_DONTNEED)
+            b_dropped = b_hashed
+    if dontneed and hasattr(os, "POSIX_FADV_DONTNEED"):
+        _fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    view.release()
+    return b_hashed
+
+# Files over hashfile's partial_limit get a sampled fingerprint: the file size,
+# then SAMPLE_WINDOW bytes from the head, the tail and N evenly spaced windows
+# between them, where N grows with the file size (one per SAMPLE_STRIDE) up to
+# SAMPLE_MAX_BODY_WINDOWS, bounding the read to ~4GiB whatever the size.
+# Digests are prefixed "sample:vN:", if you change ANY of this, bump SAMPLE_VERSION.
+SAMPLE_VERSION = 1
+SAMPLE_WINDOW = 16777216 # 16MiB
+SAMPLE_STRIDE = 268435456 # 256MiB
+SAMPLE_MAX_BODY_WINDOWS = 254
+
+def sample_offsets(size):
+    if size <= SAMPLE_WINDOW:
+        return [0]
+    n_body = min(SAMPLE_MAX_BODY_WINDOWS, -(-size // SAMPLE_STRIDE))
+    n_body = min(n_body, max(0, size // SAMPLE_WINDOW - 2)) # don't overlap the windows
+    last = size - SAMPLE_WINDOW
+    return [(k * last) // (n_body + 1) for k in range(n_body + 2)]
+
+def _pread_into(fd, view, offset):
+    # Positional reads don't touch the file offset, so these are safe to run in parallel
+    n = 0
+    while n < len(view):
+        if hasattr(os, "preadv"):
+            r = os.preadv(fd, [view[n:]], offset + n)
+        else:
+            chunk = os.pread(fd, len(view) - n, offset + n)
+            r = len(chunk)
+            view[n:n + r] = chunk
+        if not r:
+            break
+        n += r
+    return n
+
+def hash_sampled(f, halg, size):
+    """Feed the SAMPLE_VERSION sampled fingerprint of the size byte file f
+    through halg. Returns the number of bytes hashed."""
+    buff = bytearray(SAMPLE_WINDOW)
+    view = memoryview(buff)
+    fd = f.fileno()
+
+    halg.update(struct.pack(">Q", size))
+    b_hashed = 0
+    for offset in sample_offsets(size):
+        n = _pread_into(fd, view, offset)
+        halg.update(view[:n])
+        b_hashed += n
+        if hasattr(os, "POSIX_FADV_DONTNEED"):
+            _fadvise(fd, offset, n, os.POSIX_FADV_DONTNEED)
+
+    view.release()
+    return b_hashed
+
+def hashfile(path, start_clock, halg=None, bs=None, force_hash=False, partial_limit=10737418240, use_cache=USE_HASH_CACHE):
     start_time = datetime.now()
 
     hashed=False
-    mod_time = os.path.getmtime(path)
+    sampled=False
+    st = os.stat(path)
+    alg_name, halg = get_hash_algorithm(halg)
+    if st.st_size > partial_limit:
+        # Don't let a sampled digest stand in for a full one in the cache (or vice versa)
+        alg_name = "sample:v%d:%s" % (SAMPLE_VERSION, alg_name)
+
+    # If the file's stat hasn't changed since we last hashed it, trust the old digest
+    # (unless we've been told to force the hash, in which case refresh the cache)
+    hcache = None
+    if use_cache:
+        node = get_node(path)
+        hcache = cache.get_hash_cache(node[1] if node else None)
+        if hcache and not force_hash:
+            ret = hcache.get(st, alg_name)
+            if ret:
+                syslog.syslog('Cached %s (%.2fGB)' % (path, float(st.st_size) / 1e+9))
+                return ret
+
+    # Just written (by the command we're tracking, most likely)? Wait until any
+    # further write would have to move the mtime on, so the digest can be kept
+    if hcache:
+        fresh_ns = min(cache.RACY_NS, cache.RACY_NS - (time.time_ns() - st.st_mtime_ns))
+        if fresh_ns > 0:
+            time.sleep(fresh_ns / 1e9)
+    hashed_at_ns = time.time_ns()
 
-    # This seems to be causing more trouble than anything else, so just hash everything for now
-    # Best thing to do is probably attempt to fire a GET at the server and see if we have the last seen date
-    #if mod_time >= int(start_clock.strftime("%s")) or force_hash:
-    #    pass
-    #else:
-    #    # The file /probably/ hasn't change, so don't bother rehashing...
-    #    ret = 'U'
+    if not bs:
+        bs = adaptive_block_size(st.st_size)
 
     # For files less than partial_limit, just get on with it
     b_hashed = 0
-    if os.path.getsize(path) <= partial_limit:
-        f = open(path, 'rb')
-        buff = f.read(bs)
-        halg = halg()
-        halg.update(buff)
-        b_hashed = bs
-        while len(buff) > 0:
-            buff = f.read(bs)
-            halg.update(buff)
-            b_hashed += bs
-        f.close()
+    if st.st_size <= partial_limit:
+        with open(path, 'rb', buffering=0) as f:
+            halg = halg()
+            b_hashed = hash_stream(f, halg, bs, dontneed=st.st_size >= FADVISE_DONTNEED_MIN)
         hashed=True
     else:
-        # I want to ensure no hashing process takes longer than 5 minutes
-        # Caveat: The longer the file is, the more sparse the samples are
-        # NOTE This is probably a fucking terrible idea
-
-        # Assuming a total of partial_sample bytes to sample for the hash,
-        # find the skip size needed to evenly sample the file with bs blocks
-        body_sample_size = 5.243e+8 # 500MiB
-        ends_sample_size = 2.147e+9 # 2GiB
-        body_consec_samples = math.ceil(body_sample_size/bs)
-        ends_consec_samples = math.ceil(ends_sample_size/bs)
-
-        file_size_body = int(os.path.getsize(path) - ((2*ends_sample_size) + (2*body_sample_size)))
-        body_num_samples = int( (file_size_body * partial_sample) / body_sample_size) # number of body samples needed
-        body_seek_size = int(file_size_body / body_num_samples)
-
-        # Read the first blocks
-        f = open(path, 'rb')
-        halg = halg()
-        for i in range(ends_consec_samples):
-            buff = f.read(bs)
-            halg.update(buff)
-            b_hashed += bs
-
-        # Now seek to the evenly distributed sample points across the body
-        pos = f.tell() + body_sample_size
-        for i in range(body_num_samples):
-            f.seek(int(pos))
-            for i in range(body_consec_samples):
-                buff = f.read(bs)
-                halg.update(buff)
-                b_hashed += bs
-            pos = f.tell() + body_seek_size
-
-        f.seek(int(os.path.getsize(path) - ends_sample_size))
-        while len(buff) > 0:
-            buff = f.read(bs)
-            halg.update(buff)
-            b_hashed += bs
-        f.close()
+        # Too big to hash in reasonable time, take a sampled fingerprint instead
+        with open(path, 'rb', buffering=0) as f:
+            halg = halg()
+            b_hashed = hash_sampled(f, halg, st.st_size)
         hashed=True
+        sampled=True
 
     ret = '0'
     if hashed:
         ret = halg.hexdigest()
+        if sampled:
+            # Make sure a sampled digest can never be mistaken for a full one
+            ret = "sample:v%d:%s" % (SAMPLE_VERSION, ret)
+        if hcache:
+            # Only keep it if nothing changed the file while we were reading it
+            st_after = walk.stat(path)
+            if st_after and (st_after.st_ino, st_after.st_size, st_after.st_mtime_ns, st_after.st_ctime_ns) == (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+                hcache.put(st, alg_name, ret, hashed_at_ns)
 
     end_time = datetime.now()
     hash_time = end_time - start_time
-    syslog.syslog('Hashed %s (~%.2fGB of %.2fGB in %s)' % (path, float(b_hashed) / 1e+9, float(os.path.getsize(path)) / 1e+9, str(hash_time)))
+    syslog.syslog('Hashed %s (~%.2fGB of %.2fGB in %s)' % (path, float(b_hashed) / 1e+9, float(st.st_size) / 1e+9, str(hash_time)))
 
     return ret
 
+
+def combine_digests(named_digests, halg=None):
+    """A single digest for a set of files from their (name, digest) pairs,
+    which doesn't depend on the order they come in."""
+    alg_name, halg = get_hash_algorithm(halg)
+    h = halg()
+    for name, digest in sorted(named_digests):
+        h.update(("%s\0%s\n" % (name, digest)).encode("utf-8"))
+    return h.hexdigest()
+
+def hashfiles(paths, start_clock, halg=None, lookup=None, workers=4):
+    """Digest a set of files (e.g. the parts of an index) as one, hashing them
+    on a pool of threads. lookup(path) is asked first for any digest that is
+    already known. Files are named by their basename in the combined digest."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def digest(path):
+        known = lookup(path) if lookup else None
+        return known or hashfile(path, start_clock, halg=halg)
+
+    paths = sorted(paths)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as pool:
+        digests = list(pool.map(digest, paths))
+    return combine_digests(zip([os.path.basename(p) for p in paths], digests), halg=halg)
@@ -0,0 +1,61 @@
+import fnmatch
+import os
+
+from . import conf
+
+# Names (globs) to never descend into or report, e.g. [".git", "*.tmp"]
+IGNORE = getattr(conf, "IGNORE", [])
+
+def is_ignored(name, ignore=None):
+    if ignore is None:
+        ignore = IGNORE
+    for pattern in ignore:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+def list_dir(path, ignore=None):
+    """List path with a single os.scandir, returning (files, dirs) lists of
+    DirEntry. is_dir comes from the cached d_type so needs no extra stat, and
+    entry.stat() is cached once called. Returns two empty lists if path can't
+    be listed."""
+    files = []
+    dirs = []
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return files, dirs
+    with it:
+        for entry in it:
+            if is_ignored(entry.name, ignore):
+                continue
+            try:
+                if entry.is_dir():
+                    dirs.append(entry)
+                else:
+                    files.append(entry)
+            except OSError:
+                # Gone before we got to it
+                pass
+    return files, dirs
+
+def walk(path, max_depth=None, ignore=None):
+    """Yield (DirEntry, depth) for every file under path, descending at most
+    max_depth levels of subdirs (None for no limit, 0 for just path itself)."""
+    stack = [(path, 0)]
+    while stack:
+        current, depth = stack.pop()
+        files, dirs = list_dir(current, ignore=ignore)
+        for entry in files:
+            yield entry, depth
+        if max_depth is None or depth < max_depth:
+            for entry in dirs:
+                if not entry.is_symlink(): # don't go round in circles
+                    stack.append((entry.path, depth + 1))
+
+def stat(path):
+    # One stat to answer exists/isfile/isdir, None if the path doesn't exist
+    try:
+        return os.stat(path)
+    except (OSError, ValueError):
+        return None
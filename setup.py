@@ -9,7 +9,6 @@ requirements = [
     "paramiko",
     "pillow",
     "requests",
-    "whichcraft",
 ]
 
 test_requirements = [
@@ -36,6 +35,7 @@ setuptools.setup(
     entry_points = {
         'console_scripts': [
             'chitin-script = chitin.client:exec_script',
+            'chitin-sweep = chitin.client:exec_sweep',
             'chitin-tag = chitin.client:tag',
             'chitin-notice = chitin.client:notice',
             'chitin-group = chitin.client:group',
@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The client reads its settings from chitin/client/conf.py, which is local to each
+# install, so stand one in if this checkout doesn't have it
+try:
+    import chitin.client.conf
+except ImportError:
+    sys.modules["chitin.client.conf"] = types.ModuleType("chitin.client.conf")
+from chitin.client import conf
+conf.KEY = "test-key"
+conf.ROOTS = getattr(conf, "ROOTS", {})
+
+from chitin.client.api import base
+
+
+class StandInServer(object):
+    """Just enough of the server's API: records what it is sent, refuses
+    any message with "bad" in its payload (400) and can fail the first few
+    requests with a 503."""
+
+    def __init__(self, batch=True, fail_first=0):
+        self.received = []
+        self.batches = 0
+        self.batch = batch
+        self.fail_first = fail_first
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status = server.handle(self.path, body)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+
+    def handle(self, path, body):
+        if self.fail_first > 0:
+            self.fail_first -= 1
+            return 503
+        if path.endswith("/batch/"):
+            if not self.batch:
+                return 404
+            self.batches += 1
+            if any(m["payload"].get("bad") for m in body["messages"]):
+                return 400
+            self.received.extend([m["payload"]["n"] for m in body["messages"]])
+            return 200
+        if body.get("bad"):
+            return 400
+        self.received.append(body["n"])
+        return 200
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.dead_dir = os.path.join(self.spool_dir, "dead")
+        self.batch_wait = base.BATCH_WAIT
+        base.BATCH_WAIT = 0.1
+        self.server = None
+
+    def tearDown(self):
+        base.BATCH_WAIT = self.batch_wait
+        if self.server:
+            self.server.close()
+        shutil.rmtree(self.spool_dir)
+
+    def send(self, payloads, **server_args):
+        self.server = StandInServer(**server_args)
+        conf.ENDPOINT = self.server.url
+        outbox = base.Outbox(spool_dir=self.spool_dir, dead_letter_dir=self.dead_dir)
+        for payload in payloads:
+            outbox.put("command/update", payload)
+        self.assertTrue(outbox.flush(timeout=10))
+        return outbox
+
+    def test_refused_message_is_dead_lettered(self):
+        self.send([{"n": 1, "bad": True}, {"n": 2}, {"n": 3}], batch=False)
+        self.assertEqual(self.server.received, [2, 3])
+        self.assertEqual(len(os.listdir(self.dead_dir)), 1)
+        self.assertEqual([p for p in os.listdir(self.spool_dir) if p.endswith(".json")], [])
+
+    def test_refused_batch_is_sent_one_at_a_time(self):
+        self.send([{"n": 1, "bad": True}, {"n": 2}, {"n": 3}])
+        self.assertEqual(self.server.batches, 1)
+        self.assertEqual(self.server.received, [2, 3])
+        self.assertEqual(len(os.listdir(self.dead_dir)), 1)
+
+    def test_batches(self):
+        self.send([{"n": n} for n in range(5)])
+        self.assertEqual(sorted(self.server.received), list(range(5)))
+        self.assertFalse(os.path.exists(self.dead_dir))
+
+    def test_server_errors_are_retried(self):
+        self.send([{"n": 1}, {"n": 2}], fail_first=1)
+        self.assertEqual(sorted(self.server.received), [1, 2])
+        self.assertFalse(os.path.exists(self.dead_dir))
+
+    def test_dead_letters_are_not_recovered(self):
+        self.send([{"n": 1, "bad": True}], batch=False)
+        self.server.close()
+
+        self.server = StandInServer()
+        conf.ENDPOINT = self.server.url
+        outbox = base.Outbox(spool_dir=self.spool_dir, dead_letter_dir=self.dead_dir)
+        outbox.recover()
+        self.assertTrue(outbox.flush(timeout=5))
+        self.assertEqual(self.server.received, [])
+        self.assertEqual(len(os.listdir(self.dead_dir)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
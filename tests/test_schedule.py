@@ -0,0 +1,57 @@
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+# As in test_outbox, stand in a conf.py if this checkout doesn't have one
+try:
+    import chitin.client.conf
+except ImportError:
+    sys.modules["chitin.client.conf"] = types.ModuleType("chitin.client.conf")
+from chitin.client import conf
+conf.ROOTS = getattr(conf, "ROOTS", {})
+
+from chitin.client import parse_tokens, schedule
+
+
+class InferDependenciesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+        for name in ["ref.fa", "s1.fq", "s2.fq", "idx.1.bt2", "idx.2.bt2", "done.sam"]:
+            open(name, "w").close()
+        os.mkdir("data")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def deps(self, *commands):
+        return schedule.infer_dependencies([parse_tokens(command.split(" ")) for command in commands])
+
+    def test_shared_inputs_run_side_by_side(self):
+        self.assertEqual(self.deps("bwa mem ref.fa s1.fq > s1.sam", "bwa mem ref.fa s2.fq > s2.sam"), {0: set(), 1: set()})
+        self.assertEqual(self.deps("bowtie2 -x idx -U s1.fq -S o1.sam", "bowtie2 -x idx -U s2.fq -S o2.sam"), {0: set(), 1: set()})
+
+    def test_numbers_are_not_paths(self):
+        self.assertEqual(self.deps("sleep 0.5; echo 1,1", "sleep 0.5; echo 1,1"), {0: set(), 1: set()})
+
+    def test_reading_an_output_waits(self):
+        self.assertEqual(self.deps("bwa mem ref.fa s2.fq > s2.sam", "wc -l s2.sam"), {0: set(), 1: {0}})
+        # Redirecting over a file that is already there still makes it an output
+        self.assertEqual(self.deps("bwa mem ref.fa s1.fq > done.sam", "wc -l done.sam"), {0: set(), 1: {0}})
+
+    def test_writing_the_same_output_waits(self):
+        self.assertEqual(self.deps("cat s1.fq > both.fq", "cat s2.fq > both.fq"), {0: set(), 1: {0}})
+
+    def test_writing_into_a_named_dir_waits(self):
+        self.assertEqual(self.deps("find data", "touch data/new.txt"), {0: set(), 1: {0}})
+        self.assertEqual(self.deps("find data -name a", "find data -name b"), {0: set(), 1: set()})
+
+
+if __name__ == "__main__":
+    unittest.main()
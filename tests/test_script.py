@@ -0,0 +1,52 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+# As in test_outbox, stand in a conf.py if this checkout doesn't have one
+try:
+    import chitin.client.conf
+except ImportError:
+    sys.modules["chitin.client.conf"] = types.ModuleType("chitin.client.conf")
+
+from chitin.client import script
+
+
+class ReadParamSetsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.work_dir, name)
+        with open(path, "w") as fh:
+            fh.write(text)
+        return path
+
+    def test_json_array(self):
+        path = self.write("p.json", json.dumps([{"a": "1"}, {"a": "2"}], indent=2))
+        self.assertEqual(script.read_param_sets(path), [{"a": "1"}, {"a": "2"}])
+
+    def test_json_object(self):
+        path = self.write("p.json", json.dumps({"a": "1"}, indent=2))
+        self.assertEqual(script.read_param_sets(path), [{"a": "1"}])
+
+    def test_jsonl(self):
+        text = '{"a": "1"}\n\n{"a": "2"}\n'
+        self.assertEqual(script.read_param_sets(self.write("p.jsonl", text)), [{"a": "1"}, {"a": "2"}])
+        # Still read from a .json file, as it used to be
+        self.assertEqual(script.read_param_sets(self.write("p.json", text)), [{"a": "1"}, {"a": "2"}])
+
+    def test_tsv(self):
+        path = self.write("p.tsv", "a\tb\n1\tx\n2\ty\n")
+        self.assertEqual(script.read_param_sets(path), [{"a": "1", "b": "x"}, {"a": "2", "b": "y"}])
+
+
+if __name__ == "__main__":
+    unittest.main()